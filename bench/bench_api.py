@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Benchmark of the API: requests per second of /api/list and /api/transcript against local redis
+# Requests go through flask test client, or to a running API with --url
+
+import os
+import sys
+import time
+import random
+import argparse
+import threading
+
+try:
+    from urllib2 import Request, urlopen, HTTPError
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import scribbled_api as api
+import scribbled_store as store
+
+
+def populate(names, items, maxlen):
+    for name in names:
+        with api.r.pipeline() as pipe:
+            pipe.multi()
+            pipe.sadd(store.channels_key, name)
+            pipe.hset(name, 'src', 'lavfi:sine')
+            pipe.hset(name, 'lang', 'en-US')
+            pipe.hset(name, 'creds', 'e30=')
+            pipe.hset(name, 'state', 'stop')
+            pipe.execute()
+
+        for i in range(items):
+            store.append_transcript(api.r, name, int(time.time()) - items + i, [
+                'the creator of steam valve is the one of the gist of premier gaming developers in the world {}'.format(i)
+            ], maxlen)
+
+
+def remove(names):
+    for name in names:
+        store.delete_transcript(api.r, name)
+    with api.r.pipeline() as pipe:
+        pipe.multi()
+        pipe.srem(store.channels_key, *names)
+        pipe.delete(*names)
+        pipe.execute()
+
+
+def client_request(client, path, headers):
+    return client.get(path, headers = headers).status_code
+
+
+def url_request(url, path, headers):
+    try:
+        return urlopen(Request(url + path, headers = headers)).getcode()
+    except HTTPError as e:
+        return e.code
+
+
+def run(request, paths, headers, duration, concurrency):
+    counts = []
+    errors = []
+
+    def worker():
+        count, failed = 0, 0
+        deadline = time.time() + duration
+        while time.time() < deadline:
+            status = request(random.choice(paths), headers)
+            count += 1
+            if status not in [200, 304]:
+                failed += 1
+        counts.append(count)
+        errors.append(failed)
+
+    threads = [threading.Thread(target = worker) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sum(counts) / float(duration), sum(errors)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark of the API')
+    parser.add_argument('--channels', type = int, default = 100)
+    parser.add_argument('--items', type = int, default = 360, help = 'transcript items per channel')
+    parser.add_argument('--duration', type = int, default = 10, help = 'seconds per scenario')
+    parser.add_argument('--concurrency', type = int, default = 4)
+    parser.add_argument('--url', help = 'base url of a running API, e.g. http://127.0.0.1:8080')
+    args = parser.parse_args()
+
+    names = ['bench{}'.format(i) for i in range(args.channels)]
+    populate(names, args.items, args.items)
+
+    if args.url:
+        request = lambda path, headers: url_request(args.url, path, headers)
+    else:
+        api.application.logger.disabled = True
+        client = api.application.test_client()
+        request = lambda path, headers: client_request(client, path, headers)
+
+    etag = api.r.hget(store.doc_key(names[0]), 'etag')
+    scenarios = [
+        ('/api/list', ['/api/list'], {}),
+        ('/api/transcript/<name>', ['/api/transcript/{}'.format(name) for name in names], {}),
+        ('/api/transcript/<name> gzip', ['/api/transcript/{}'.format(name) for name in names],
+            {'Accept-Encoding': 'gzip'}),
+        ('/api/transcript/<name> 304', ['/api/transcript/{}'.format(names[0])],
+            {'If-None-Match': '"{}"'.format(etag)}),
+        ('/api/transcript/<name>?set=10', ['/api/transcript/{}?set=10'.format(name) for name in names], {}),
+    ]
+
+    try:
+        for title, paths, headers in scenarios:
+            rps, errors = run(request, paths, headers, args.duration, args.concurrency)
+            print('{:40} {:10.1f} req/s {:6} errors'.format(title, rps, errors))
+    finally:
+        remove(names)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# Benchmark of the bot: channels per core, audio-to-transcript lag and memory per channel
+# Requires local redis and ffmpeg, audio is generated by ffmpeg lavfi (or read from a local file)
+# and the recognizer is replaced with bench/fake_recognizer.py, so no google credentials are needed
+
+import os
+import sys
+import time
+import base64
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import fake_recognizer
+import scribbled_bot as bot
+import scribbled_store as store
+import scribbled_metrics as metrics
+
+
+def process_tree(root):
+    parents = {}
+    for entry in os.listdir('/proc'):
+        if entry.isdigit():
+            try:
+                with open('/proc/{}/stat'.format(entry)) as f:
+                    stat = f.read()
+            except IOError:
+                continue
+            parents[int(entry)] = int(stat.rsplit(')', 1)[1].split()[1])
+
+    tree = [root]
+    for pid in tree:
+        tree.extend(child for child, parent in parents.items() if parent == pid)
+    return tree
+
+
+def cpu_seconds(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/stat'.format(pid)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except IOError:
+            continue
+        total += int(fields[11]) + int(fields[12])
+    return total / float(os.sysconf('SC_CLK_TCK'))
+
+
+def rss_bytes(pids):
+    total = 0
+    for pid in pids:
+        try:
+            with open('/proc/{}/statm'.format(pid)) as f:
+                total += int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except IOError:
+            continue
+    return total
+
+
+def commit_lag(names):
+    lag_sum, lag_count = 0.0, 0
+    for metric in metrics.registry().collect():
+        if metric.name != 'scribbled_commit_lag_seconds':
+            continue
+        for sample in metric.samples:
+            sample_name, labels, value = sample[0], sample[1], sample[2]
+            if labels.get('channel') not in names:
+                continue
+            if sample_name.endswith('_sum'):
+                lag_sum += value
+            elif sample_name.endswith('_count'):
+                lag_count += value
+    return lag_sum / lag_count if lag_count else None, int(lag_count)
+
+
+def set_channels(names, source, state):
+    with bot.r.pipeline() as pipe:
+        pipe.multi()
+        for name in names:
+            pipe.sadd(store.channels_key, name)
+            pipe.hset(name, 'src', source)
+            pipe.hset(name, 'lang', 'en-US')
+            pipe.hset(name, 'creds', base64.b64encode(b'{}'))
+            pipe.hset(name, 'state', state)
+        pipe.execute()
+
+
+def remove_channels(names):
+    for name in names:
+        store.delete_transcript(bot.r, name)
+    with bot.r.pipeline() as pipe:
+        pipe.multi()
+        pipe.srem(store.channels_key, *names)
+        pipe.delete(*names)
+        pipe.execute()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark of the bot with a fake recognizer')
+    parser.add_argument('--channels', type = int, default = 10)
+    parser.add_argument('--duration', type = int, default = 60, help = 'seconds of measurement')
+    parser.add_argument('--warmup', type = int, default = 15, help = 'seconds before measurement')
+    parser.add_argument('--source', default = 'lavfi:sine=frequency={freq}:sample_rate=16000',
+        help = 'ffmpeg source, lavfi:<filtergraph> or a local file, {freq} differs per channel')
+    parser.add_argument('--shared-source', action = 'store_true', help = 'all channels read the same source')
+    parser.add_argument('--engine', default = 'process', choices = ['process', 'thread'])
+    parser.add_argument('--workers', type = int, default = 0)
+    parser.add_argument('--streaming', action = 'store_true')
+    parser.add_argument('--latency', type = float, default = 0.3, help = 'fake recognizer latency')
+    parser.add_argument('--port', type = int, default = 8090, help = 'fake recognizer port')
+    args = parser.parse_args()
+
+    fake_recognizer.start('127.0.0.1', args.port, args.latency, args.latency / 3)
+
+    bot.recognizer_backend = 'http'
+    bot.recognizer_url = 'http://127.0.0.1:{}'.format(args.port)
+    bot.streaming = args.streaming
+    bot.engine = args.engine
+    bot.processes = {}
+    bot.workers = [bot.Worker(index) for index in range(args.workers or bot.cpu_count())]
+
+    names = ['bench{}'.format(i) for i in range(args.channels)]
+
+    bot.create_dir_first()
+    for i, name in enumerate(names):
+        set_channels([name], args.source.format(freq = 200 + (0 if args.shared_source else i * 10)), 'start')
+
+    try:
+        bot.run_channels()
+        time.sleep(args.warmup)
+
+        pids = process_tree(os.getpid())
+        cpu_start = cpu_seconds(pids)
+        started = time.time()
+
+        time.sleep(args.duration)
+
+        pids = process_tree(os.getpid())
+        cores = (cpu_seconds(pids) - cpu_start) / (time.time() - started)
+        rss = rss_bytes(pids)
+        lag, commits = commit_lag(names)
+
+        print('channels:              {}'.format(args.channels))
+        print('engine:                {} ({} workers)'.format(args.engine, len(bot.workers)))
+        print('cores used:            {:.2f}'.format(cores))
+        print('channels per core:     {:.1f}'.format(args.channels / cores if cores else float('inf')))
+        print('memory per channel:    {:.1f} MB'.format(rss / float(args.channels) / 1024 / 1024))
+        print('commits:               {}'.format(commits))
+        print('audio-to-commit lag:   {}'.format('{:.2f} sec'.format(lag) if lag is not None else 'n/a'))
+
+    finally:
+        for name in names:
+            bot.r.hset(name, 'state', 'stop')
+        bot.run_channels()
+        remove_channels(names)
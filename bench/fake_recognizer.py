@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+
+# Local stand-in for the recognizer, used with recognizer_backend = 'http'
+# POST /recognize?lang=<lang>&rate=<sample rate> with raw s16le audio as the body
+# returns {"transcript": ["word word ..."]} after configured latency
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+
+words = 'the creator of steam valve is one of the premier gaming developers in the world'.split()
+
+
+class FakeRecognizerServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency, jitter, words_per_sec):
+        HTTPServer.__init__(self, address, FakeRecognizerHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.words_per_sec = words_per_sec
+        self.requests = 0
+        self.audio_sec = 0.0
+        self.lock = threading.Lock()
+
+
+class FakeRecognizerHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/recognize':
+            self.send_error(404)
+            return
+
+        args = parse_qs(url.query)
+        rate = int(args.get('rate', ['16000'])[0])
+        data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        audio_sec = len(data) / 2.0 / rate
+
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.audio_sec += audio_sec
+
+        time.sleep(max(0, self.server.latency + random.uniform(-self.server.jitter, self.server.jitter)))
+
+        count = int(audio_sec * self.server.words_per_sec)
+        transcript = [' '.join(random.choice(words) for i in range(count))] if count else []
+
+        body = json.dumps({'transcript': transcript}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start(host, port, latency, jitter = 0, words_per_sec = 2):
+    server = FakeRecognizerServer((host, port), latency, jitter, words_per_sec)
+    thread = threading.Thread(target = server.serve_forever, name = 'fake_recognizer')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Local stand-in for the recognizer')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8090)
+    parser.add_argument('--latency', type = float, default = 0.3, help = 'seconds per request')
+    parser.add_argument('--jitter', type = float, default = 0.1, help = 'random deviation of latency')
+    parser.add_argument('--words-per-sec', type = float, default = 2, help = 'words in transcript per second of audio')
+    args = parser.parse_args()
+
+    server = FakeRecognizerServer((args.host, args.port), args.latency, args.jitter, args.words_per_sec)
+    sys.stderr.write('Fake recognizer listening on {}:{}\n'.format(args.host, args.port))
+    server.serve_forever()
@@ -3,14 +3,81 @@ debug = True
 host = '127.0.0.1'
 port = 8080
 
+log_level = 'INFO'
+metrics_dir = './work/metrics'
+metrics_port = 9108
+
+long_poll_max_sec = 10
+sse_max_sec = 10
+sse_retry_ms = 1000
+search_limit = 100
+channel_cache_size = 10000
+channel_cache_sec = 5
+
 sample_rate = 16000
 chunk_sec = 10
+min_segment_sec = 5
+max_segment_sec = 15
+segment_lookahead_sec = 1.5
 chunk_set_len = 1
+chunk_overlap_sec = 0
+stitch_words = 20
 offset_sec = 10
 
+ffmpeg_stall_sec = 20
+ffmpeg_backoff_sec = 1
+ffmpeg_backoff_max_sec = 30
+
+streaming = False
+stream_frame_sec = 0.1
+stream_session_sec = 290
+interim_results = False
+
+recognizer_backend = 'google'
+encoding = 'linear16'
+recognizer_url = 'http://127.0.0.1:8090'
+recognizer_utterance_sec = 5
+
+scheduler = True
+scheduler_concurrency = 300
+scheduler_requests_per_sec = 50
+scheduler_audio_sec_per_sec = 1000
+scheduler_burst_sec = 5
+scheduler_max_wait_sec = 30
+scheduler_poll_sec = 0.05
+scheduler_hold_sec = 60
+
+ring_sec = 60
+ring_policy = 'drop'
+ring_report_sec = 5
+
+vad_threshold = None
+vad_frame_ms = 30
+vad_hangover_ms = 300
+
 transcript_set_len = 360
 
+archive = True
+archive_segment_bytes = 4 * 1024 * 1024
+# <work_dir>/archive by default, must be one directory shared by all bot nodes and API hosts
+archive_dir = None
+
 sleep_sec = 5
+reconcile_sec = 60
+
+engine = 'process'
+engine_workers = 0
+
+backfill_jobs = 1
+backfill_workers = 0
+backfill_priority = -10
+backfill_retries = 3
+backfill_set_len = 10000
+
+node_id = None
+node_capacity = 100
+lease_ms = 30000
+heartbeat_sec = 5
 
 work_dir = './work'
 
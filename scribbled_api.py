@@ -3,12 +3,18 @@
 import os
 import sys
 import json
+import time
 import redis
 import base64
+import threading
+from collections import OrderedDict
 
-from flask import Flask, Response, request, abort
+from flask import Flask, Response, request, abort, stream_with_context, g
 
 import config
+import scribbled_metrics as metrics
+import scribbled_store as store
+import scribbled_archive as archive
 
 application = Flask(__name__)
 
@@ -16,6 +22,14 @@ host = getattr(config, 'host')
 port = getattr(config, 'port')
 debug = getattr(config, 'debug')
 
+long_poll_max_sec = getattr(config, 'long_poll_max_sec')
+sse_max_sec = getattr(config, 'sse_max_sec')
+sse_retry_ms = getattr(config, 'sse_retry_ms')
+search_limit = getattr(config, 'search_limit')
+archive_dir = getattr(config, 'archive_dir') or os.path.join(getattr(config, 'work_dir'), 'archive')
+channel_cache_size = getattr(config, 'channel_cache_size')
+channel_cache_sec = getattr(config, 'channel_cache_sec')
+
 redis_host = getattr(config, 'redis_host')
 redis_port = getattr(config, 'redis_port')
 
@@ -23,6 +37,158 @@ r = redis.Redis(host=redis_host, port=redis_port, db=0)
 r.ping()
 
 
+class ChannelCache(object):
+    # data of channels per worker process, entries are dropped by channel events of the listener,
+    # by ttl (the bot updates pids and queue stats without events) and by size, least recently used first
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.channels = OrderedDict()
+        self.names = None
+        self.generation = 0
+
+    def get_names(self):
+        listener.ensure()
+        with self.lock:
+            if self.names is not None and self.names[0] > time.time():
+                metrics.channel_cache.labels('hit').inc()
+                return self.names[1]
+            generation = self.generation
+
+        metrics.channel_cache.labels('miss').inc()
+        names = store.channel_names(r)
+        with self.lock:
+            # data read before an invalidation is not cached
+            if generation == self.generation:
+                self.names = (time.time() + self.ttl, names)
+        return names
+
+    def get_channels(self, names):
+        # returns (data, owner) of every channel, data is empty if the channel is not registered
+        listener.ensure()
+        found = {}
+        now = time.time()
+        with self.lock:
+            for name in names:
+                item = self.channels.get(name)
+                if item is not None and item[0] > now:
+                    self.channels[name] = self.channels.pop(name)
+                    found[name] = item[1]
+            generation = self.generation
+
+        missing = [name for name in set(names) if name not in found]
+        metrics.channel_cache.labels('hit').inc(len(names) - len(missing))
+        if missing:
+            metrics.channel_cache.labels('miss').inc(len(missing))
+            data = zip(missing, zip(store.get_channels(r, missing), store.channel_owners(r, missing)))
+            found.update(data)
+            with self.lock:
+                if generation == self.generation:
+                    for name in missing:
+                        self.channels.pop(name, None)
+                        self.channels[name] = (now + self.ttl, found[name])
+                    while len(self.channels) > self.size:
+                        self.channels.popitem(last = False)
+
+        return [found[name] for name in names]
+
+    def exists(self, name):
+        return bool(self.get_channels([name])[0][0])
+
+    def invalidate(self, name = None):
+        with self.lock:
+            self.generation += 1
+            self.names = None
+            if name is None:
+                self.channels.clear()
+            else:
+                self.channels.pop(name, None)
+
+
+class TranscriptListener(object):
+    # one subscription to transcript updates and channel events per worker process shared by all clients
+
+    def __init__(self):
+        self.pid = None
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.sequences = {}
+
+    def ensure(self):
+        # uwsgi forks workers after import, so the thread is started by the first request of the worker
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                thread = threading.Thread(target = self.run, name = 'transcript_listener')
+                thread.daemon = True
+                thread.start()
+
+    def run(self):
+        while True:
+            try:
+                pubsub = r.pubsub(ignore_subscribe_messages = True)
+                pubsub.subscribe(store.updates_channel, store.events_channel)
+                # events could be missed while not subscribed
+                channel_cache.invalidate()
+                for message in pubsub.listen():
+                    name = json.loads(message['data'])['name']
+                    if message['channel'] == store.events_channel:
+                        channel_cache.invalidate(name)
+                        continue
+                    with self.cond:
+                        self.sequences[name] = self.sequences.get(name, 0) + 1
+                        self.cond.notify_all()
+            except Exception as e:
+                application.logger.error('Transcript listener failed: {0}'.format(e), exc_info=True)
+                time.sleep(1)
+
+    def sequence(self, name):
+        self.ensure()
+        with self.cond:
+            return self.sequences.get(name, 0)
+
+    def wait(self, name, sequence, timeout):
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.sequences.get(name, 0) == sequence:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+        return True
+
+
+listener = TranscriptListener()
+channel_cache = ChannelCache(channel_cache_size, channel_cache_sec)
+
+
+def wait_transcript(name, cursor, timeout):
+    sequence = listener.sequence(name)
+    entries = store.read_after(r, name, cursor)
+    if not entries and listener.wait(name, sequence, timeout):
+        entries = store.read_after(r, name, cursor)
+    return entries
+
+
+@application.before_request
+def start_timer():
+    g.started = time.time()
+
+
+@application.after_request
+def observe_request(response):
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    metrics.request_latency.labels(route, request.method, response.status_code).observe(time.time() - g.started)
+    return response
+
+
+@application.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype = metrics.content_type)
+
+
 @application.route('/api/list', methods=['GET'])
 def get_list():
     application.logger.debug('Requested list of channels')
@@ -31,27 +197,23 @@ def get_list():
     channels = []
 
     try:
-        for name in r.keys('*'):
-
-            application.logger.debug('Getting data for channel {}'.format(name))
-
-            src = r.hget(name, 'src')
-            lang = r.hget(name, 'lang')
-            creds = r.hget(name, 'creds')
-            state = r.hget(name, 'state')
-            pid = r.hget(name, 'pid')
-            pid_ffmpeg = r.hget(name, 'pid_ffmpeg')
+        names = channel_cache.get_names()
+        application.logger.debug('Getting data for channels {}'.format(names))
 
+        for name, (channel, owner) in zip(names, channel_cache.get_channels(names)):
             channels.append({
                 'name': name,
-                'src': src,
-                'land': lang,
-                'state': state,
-                'pid': pid,
-                'pid_ffmpeg': pid_ffmpeg
+                'node': owner,
+                'src': channel.get('src'),
+                'land': channel.get('lang'),
+                'state': channel.get('state'),
+                'pid': channel.get('pid'),
+                'pid_ffmpeg': channel.get('pid_ffmpeg'),
+                'queue_depth': channel.get('queue_depth'),
+                'queue_dropped': channel.get('queue_dropped')
             })
 
-        response.set_data(json.dumps(channels))
+        response.set_data(store.json_dumps(channels))
         response.mimetype = 'application/json'
         response.status_code = 200
 
@@ -65,6 +227,51 @@ def get_list():
     return response
 
 
+def check_channel(name, src, lang, creds, state, options):
+    assert name is not None, 'Channel has no field name'
+    assert src is not None, 'Channel {} has no field src'.format(name)
+    assert lang is not None, 'Channel {} has no field lang'.format(name)
+    assert creds is not None, 'Channel {} has no field creds'.format(name)
+    assert state is not None, 'Channel {} has no field state'.format(name)
+
+    assert '|' not in name, 'Channel name cannot have pipe symbol (|)'
+    assert state in ['start', 'stop'], 'Channel {} state must be one of [start, stop] but found {}'.format(name, state)
+    assert options.get('encoding') in [None, 'linear16', 'flac', 'ogg_opus'], \
+        'Channel {} encoding must be one of [linear16, flac, ogg_opus] but found {}'.format(name, options.get('encoding'))
+
+
+def save_channel(pipe, name, src, lang, creds, state, options):
+    pipe.sadd(store.channels_key, name)
+    pipe.hset(name, 'src', src)
+    pipe.hset(name, 'lang', lang)
+    pipe.hset(name, 'creds', creds)
+    pipe.hset(name, 'state', state)
+    for field, value in options.items():
+        if value is not None:
+            pipe.hset(name, field, value)
+    store.publish_event(pipe, name, 'register')
+
+
+def request_names():
+    # names of channels as JSON list (or object with list "names") or comma separated argument names
+    if request.is_json:
+        names = request.json.get('names') if isinstance(request.json, dict) else request.json
+    else:
+        names = request.values.get('names', '').split(',')
+    return [name for name in names or [] if name]
+
+
+def no_channels():
+    application.logger.warn('No channels requested')
+    response = Response()
+    response.set_data(json.dumps({
+        'result': 'no channels'
+    }))
+    response.mimetype = 'application/json'
+    response.status_code = 400
+    return response
+
+
 @application.route('/api/register/<name2>', methods=['POST'])
 def register_channel(name2):
     application.logger.debug('Requested registration of channels')
@@ -79,6 +286,7 @@ def register_channel(name2):
             lang = request.json['lang']
             creds = request.json['creds']
             state = request.json['state']
+            options = dict((field, request.json.get(field)) for field in store.channel_options)
         except Exception as e:
             application.logger.error('Could not parse json: {0}'.format(e.message), exc_info=True)
             response.set_data(json.dumps({
@@ -95,6 +303,7 @@ def register_channel(name2):
             lang = request.form.get('lang')
             creds = request.form.get('creds')
             state = request.form.get('state')
+            options = dict((field, request.form.get(field)) for field in store.channel_options)
         else:
             application.logger.debug('Got parameters as arguments')
             name = request.args.get('name')
@@ -102,6 +311,7 @@ def register_channel(name2):
             lang = request.args.get('lang')
             creds = request.args.get('creds')
             state = request.args.get('state')
+            options = dict((field, request.args.get(field)) for field in store.channel_options)
 
     else:
         application.logger.error('Unsupported content type: {0}'.format(request.content_type))
@@ -111,15 +321,8 @@ def register_channel(name2):
         response.status_code = 400
         return response
 
-    assert name is not None, 'Channel has no field name'
-    assert src is not None, 'Channel {} has no field src'.format(name)
-    assert lang is not None, 'Channel {} has no field lang'.format(name)
-    assert creds is not None, 'Channel {} has no field creds'.format(name)
-    assert state is not None, 'Channel {} has no field state'.format(name)
-
     assert name == name2, 'Channel name from URI differs from payload'
-    assert '|' not in name, 'Channel name cannot have pipe symbol (|)'
-    assert state in ['start', 'stop'], 'Channel {} state must be one of [start, stop] but found {}'.format(name, state)
+    check_channel(name, src, lang, creds, state, options)
 
     try:
         if r.exists(name):
@@ -131,10 +334,7 @@ def register_channel(name2):
 
         with r.pipeline() as pipe:
             pipe.multi()
-            pipe.hset(name, 'src', src)
-            pipe.hset(name, 'lang', lang)
-            pipe.hset(name, 'creds', creds)
-            pipe.hset(name, 'state', state)
+            save_channel(pipe, name, src, lang, creds, state, options)
             pipe.execute()
 
         response.set_data(json.dumps({
@@ -172,7 +372,11 @@ def update_channel(name):
 
             else:
                 application.logger.debug('State of channel {} updated to {}'.format(name, state))
-                r.hset(name, 'state', state)
+                with r.pipeline() as pipe:
+                    pipe.multi()
+                    pipe.hset(name, 'state', state)
+                    store.publish_event(pipe, name, state)
+                    pipe.execute()
                 result = 'updated'
 
             response.set_data(json.dumps({
@@ -211,9 +415,9 @@ def purge_channel(name):
 
     try:
         if r.exists(name):
-            if r.hexists(name, 'transcript'):
-                application.logger.debug('Purging of transcript of channel {}'.format(name))
-                r.hdel (name, 'transcript')
+            archive.delete_archive(archive_dir, name)
+            if store.delete_transcript(r, name):
+                application.logger.debug('Purged transcript of channel {}'.format(name))
                 result = 'deleted'
 
             else:
@@ -255,7 +459,16 @@ def remove_channel(name):
     try:
         if r.exists(name):
             application.logger.debug('Removing of channel {}'.format(name))
-            r.delete(name)
+            with r.pipeline() as pipe:
+                pipe.multi()
+                pipe.srem(store.channels_key, name)
+                pipe.delete(name, store.transcript_key(name), store.doc_key(name), store.lease_key(name),
+                    store.backfill_key(name), store.backfill_lease_key(name),
+                    store.backfill_transcript_key(name))
+                store.delete_index(pipe, r, name)
+                store.publish_event(pipe, name, 'remove')
+                pipe.execute()
+            archive.delete_archive(archive_dir, name)
             response.set_data(json.dumps({
                 'name': name,
                 'result': 'removed'
@@ -282,6 +495,242 @@ def remove_channel(name):
     return response
 
 
+@application.route('/api/register', methods=['POST'])
+def register_channels():
+    application.logger.debug('Requested bulk registration of channels')
+
+    response = Response()
+
+    if not request.is_json:
+        application.logger.error('Unsupported content type: {0}'.format(request.content_type))
+        response.set_data(json.dumps({
+            'result': 'unsupported content type'
+        }))
+        response.status_code = 400
+        return response
+
+    try:
+        channels = request.json.get('channels') if isinstance(request.json, dict) else request.json
+        channels = [(
+            channel['name'],
+            channel['src'],
+            channel['lang'],
+            channel['creds'],
+            channel['state'],
+            dict((field, channel.get(field)) for field in store.channel_options)
+        ) for channel in channels]
+    except Exception as e:
+        application.logger.error('Could not parse json: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'result': 'could not parse json'
+        }))
+        response.status_code = 500
+        return response
+
+    if not channels:
+        return no_channels()
+
+    for channel in channels:
+        check_channel(*channel)
+
+    try:
+        names = [channel[0] for channel in channels]
+        exist = store.channels_exist(r, names)
+        application.logger.debug('Registering channels {}'.format(names))
+
+        # all channels are registered by one transaction, so either all of them or none are stored
+        with r.pipeline() as pipe:
+            pipe.multi()
+            for channel in channels:
+                save_channel(pipe, *channel)
+            pipe.execute()
+
+        response.set_data(json.dumps([{
+            'name': name,
+            'result': 'updated' if exists else 'registered'
+        } for name, exists in zip(names, exist)]))
+        response.mimetype = 'application/json'
+        response.status_code = 200
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/start', methods=['POST'])
+@application.route('/api/stop', methods=['POST'])
+def update_channels():
+
+    state = 'start' if str(request.url_rule) == '/api/start' else 'stop'
+    names = request_names()
+
+    application.logger.debug('Requested change state of channels {} to {}'.format(names, state))
+
+    if not names:
+        return no_channels()
+
+    response = Response()
+
+    try:
+        with r.pipeline(transaction = False) as pipe:
+            for name in names:
+                pipe.exists(name)
+                pipe.hget(name, 'state')
+            replies = pipe.execute()
+
+        results = []
+        with r.pipeline() as pipe:
+            pipe.multi()
+            for i, name in enumerate(names):
+                exists, current = replies[2 * i], replies[2 * i + 1]
+                if not exists:
+                    application.logger.warn('Channel {} not registered'.format(name))
+                    result = 'channel not found'
+                elif current == state:
+                    result = 'unchanged'
+                else:
+                    pipe.hset(name, 'state', state)
+                    store.publish_event(pipe, name, state)
+                    result = 'updated'
+                results.append({
+                    'name': name,
+                    'state': state,
+                    'result': result
+                })
+            pipe.execute()
+
+        response.set_data(json.dumps(results))
+        response.mimetype = 'application/json'
+        response.status_code = 200
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'state': state,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/remove', methods=['POST'])
+def remove_channels():
+    names = request_names()
+
+    application.logger.debug('Requested removing of channels {}'.format(names))
+
+    if not names:
+        return no_channels()
+
+    response = Response()
+
+    try:
+        exist = store.channels_exist(r, names)
+        found = [name for name, exists in zip(names, exist) if exists]
+
+        if found:
+            application.logger.debug('Removing of channels {}'.format(found))
+            with r.pipeline() as pipe:
+                pipe.multi()
+                pipe.srem(store.channels_key, *found)
+                for name in found:
+                    pipe.delete(name, store.transcript_key(name), store.doc_key(name), store.lease_key(name),
+                        store.backfill_key(name), store.backfill_lease_key(name),
+                        store.backfill_transcript_key(name))
+                    store.publish_event(pipe, name, 'remove')
+                store.delete_indexes(pipe, r, found)
+                pipe.execute()
+            for name in found:
+                archive.delete_archive(archive_dir, name)
+
+        response.set_data(json.dumps([{
+            'name': name,
+            'result': 'removed' if exists else 'channel not found'
+        } for name, exists in zip(names, exist)]))
+        response.mimetype = 'application/json'
+        response.status_code = 200
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+def stream_list(items):
+    # items are serialized one by one while the response is sent
+    yield '['
+    for i, item in enumerate(items):
+        yield (', ' if i else '') + store.json_dumps(item)
+    yield ']'
+
+
+def stream_json(document, field):
+    # the list field goes last and is streamed item by item
+    items = document.pop(field)
+    yield store.json_dumps(document)[:-1] + (', ' if document else '') + '"{}": '.format(field)
+    for chunk in stream_list(items):
+        yield chunk
+    yield '}'
+
+
+def not_modified(etag, modified):
+    response = Response(status = 304)
+    response.set_etag(etag)
+    response.last_modified = int(modified)
+    return response
+
+
+def serve_document(name, ranged):
+    # full transcript is served as stored with one redis read and no parsing, the body is rebuilt
+    # only by the first request after an update of the transcript,
+    # returns response (None if it can't be served) with etag and modified time of the document
+    key = store.doc_key(name)
+    gzip = request.accept_encodings['gzip'] > 0
+    body_field = 'body_gz' if gzip else 'body'
+
+    if ranged or request.if_none_match:
+        etag, modified = r.hmget(key, 'etag', 'modified')
+        body_etag, body = None, None
+    else:
+        etag, modified, body_etag, body = r.hmget(key, 'etag', 'modified', 'body_etag', body_field)
+
+    if etag is None or ranged:
+        return None, etag, modified
+
+    if request.if_none_match.contains(etag):
+        application.logger.debug('Transcript of channel {} not modified'.format(name))
+        return not_modified(etag, modified), etag, modified
+
+    if body is None:
+        body_etag, body = r.hmget(key, 'body_etag', body_field)
+
+    if body is None or body_etag != etag:
+        application.logger.debug('Rebuilding document of channel {}'.format(name))
+        document = store.materialize_transcript(r, name)
+        if document is None:
+            return None, None, None
+        body_etag, body = document['body_etag'], document[body_field]
+
+    response = Response(body, mimetype = 'application/json')
+    if gzip:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.headers['Vary'] = 'Accept-Encoding'
+    # the body may be built from a newer transcript than the etag read above
+    response.set_etag(body_etag)
+    response.last_modified = int(modified)
+    return response, etag, modified
+
+
 @application.route('/api/transcript/<name>', methods=['GET'])
 def get_transcript(name):
     set = request.args.get('set')
@@ -292,30 +741,65 @@ def get_transcript(name):
         set_int = 0
         application.logger.debug('Requested transcript of channel {}'.format(name))
 
+    since = request.args.get('since')
+    since_int = int(since) if since is not None and since.isdigit() else None
+    until = request.args.get('until')
+    until_int = int(until) if until is not None and until.isdigit() else None
+
+    wait = request.args.get('wait')
+    if wait is not None and wait.isdigit():
+        return poll_transcript(name, min(int(wait), long_poll_max_sec), request.args.get('after'))
+
+    # items of recorded sources are kept apart from the live transcript and have no document
+    backfill = request.args.get('backfill') in ['1', 'true']
+    ranged = bool(set_int) or since_int is not None or until_int is not None
+
+    etag, modified = None, None
+    if not backfill:
+        try:
+            response, etag, modified = serve_document(name, ranged)
+            if response is not None:
+                return response
+        except Exception as e:
+            application.logger.error('Could not serve document of channel {}: {}'.format(name, e), exc_info=True)
+            etag, modified = None, None
+
+    if etag is not None:
+        etag = '{}-{}-{}-{}'.format(etag, set_int, since_int, until_int)
+        if request.if_none_match.contains(etag):
+            return not_modified(etag, modified)
+
     response = Response()
 
     try:
-        if r.exists(name):
-            if r.hexists(name, 'transcript'):
-                application.logger.debug('Getting transcript of channel {}'.format(name))
-                transcript = json.loads(r.hget(name, 'transcript'))
+        if channel_cache.exists(name):
+            key = store.backfill_transcript_key(name) if backfill else store.transcript_key(name)
+            if r.exists(key):
+                application.logger.debug('Getting transcript of channel {} since {} until {}'.format(
+                    name, since_int, until_int)
+                )
+                transcript, cursor = store.read_transcript(r, name, set_int, since_int, until_int, backfill)
+                full_set = store.transcript_length(r, name, backfill)
                 if set_int:
-                    response.set_data(json.dumps({
+                    response = Response(stream_json({
                         'name': name,
-                        'transcript': transcript[0-set_int:],
+                        'transcript': transcript,
                         'result': 'ok',
-                        'set': len(transcript[0-set_int:]),
-                        'full_set': len(transcript)
-                    }))
+                        'set': len(transcript),
+                        'full_set': full_set,
+                        'cursor': cursor
+                    }, 'transcript'), mimetype = 'application/json')
                 else:
-                    response.set_data(json.dumps({
+                    response = Response(stream_json({
                         'name': name,
                         'transcript': transcript,
                         'result': 'ok',
-                        'full_set': len(transcript)
-                    }))
-                response.mimetype = 'application/json'
-                response.status_code = 200
+                        'full_set': full_set,
+                        'cursor': cursor
+                    }, 'transcript'), mimetype = 'application/json')
+                if etag is not None:
+                    response.set_etag(etag)
+                    response.last_modified = int(modified)
 
             else:
                 application.logger.warn('Transcript of channel {} not found'.format(name))
@@ -345,6 +829,361 @@ def get_transcript(name):
     return response
 
 
+@application.route('/api/transcripts', methods=['GET'])
+def get_transcripts():
+    set = request.args.get('set')
+    set_int = int(set) if set is not None and set.isdigit() else 0
+    names = request.args.get('names')
+
+    application.logger.debug('Requested set of {} transcript of channels {}'.format(set_int, names))
+
+    response = Response()
+
+    try:
+        names = [name for name in names.split(',') if name] if names else channel_cache.get_names()
+        found = [name for name, (channel, owner) in zip(names, channel_cache.get_channels(names)) if channel]
+        transcripts = dict(zip(found, store.read_transcripts(r, found, set_int)))
+
+        results = []
+        for name in names:
+            if name not in transcripts:
+                results.append({
+                    'name': name,
+                    'result': 'channel not registered'
+                })
+                continue
+
+            transcript, cursor, full_set = transcripts[name]
+            if not full_set:
+                results.append({
+                    'name': name,
+                    'result': 'transcript not found'
+                })
+            elif set_int:
+                results.append({
+                    'name': name,
+                    'transcript': transcript,
+                    'result': 'ok',
+                    'set': len(transcript),
+                    'full_set': full_set,
+                    'cursor': cursor
+                })
+            else:
+                results.append({
+                    'name': name,
+                    'transcript': transcript,
+                    'result': 'ok',
+                    'full_set': full_set,
+                    'cursor': cursor
+                })
+
+        response = Response(stream_list(results), mimetype = 'application/json')
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+def poll_transcript(name, wait, after):
+    application.logger.debug('Requested transcript of channel {} after {} waiting {} sec'.format(name, after, wait))
+
+    response = Response()
+
+    try:
+        if channel_cache.exists(name):
+            cursor = after or store.last_cursor(r, name)
+            entries = wait_transcript(name, cursor, wait)
+
+            response.set_data(store.json_dumps({
+                'name': name,
+                'transcript': [item for entry_id, item in entries],
+                'result': 'ok',
+                'cursor': entries[-1][0] if entries else cursor
+            }))
+            response.mimetype = 'application/json'
+            response.status_code = 200
+
+        else:
+            application.logger.warn('Channel {} not registered'.format(name))
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'channel not registered'
+            }))
+            response.status_code = 404
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'name': name,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/transcript/<name>/stream', methods=['GET'])
+def stream_transcript(name):
+    application.logger.debug('Requested transcript stream of channel {}'.format(name))
+
+    def events(cursor):
+        # the stream ends before uwsgi harakiri, browsers reconnect with Last-Event-ID
+        yield 'retry: {}\n\n'.format(sse_retry_ms)
+
+        deadline = time.time() + sse_max_sec
+        while time.time() < deadline:
+            entries = wait_transcript(name, cursor, deadline - time.time())
+            if not entries:
+                yield ': keepalive\n\n'
+            for entry_id, item in entries:
+                cursor = entry_id
+                yield 'id: {}\ndata: {}\n\n'.format(entry_id, store.json_dumps(item))
+
+    response = Response()
+
+    try:
+        if channel_cache.exists(name):
+            cursor = request.headers.get('Last-Event-ID') or request.args.get('after') or store.last_cursor(r, name)
+            response = Response(stream_with_context(events(cursor)), mimetype = 'text/event-stream')
+            response.headers['Cache-Control'] = 'no-cache'
+            response.headers['X-Accel-Buffering'] = 'no'
+
+        else:
+            application.logger.warn('Channel {} not registered'.format(name))
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'channel not registered'
+            }))
+            response.status_code = 404
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'name': name,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/archive/<name>', methods=['GET'])
+def get_archive(name):
+    since = request.args.get('since')
+    since_int = int(since) if since is not None and since.isdigit() else None
+    until = request.args.get('until')
+    until_int = int(until) if until is not None and until.isdigit() else None
+
+    application.logger.debug('Requested archive of channel {} since {} until {}'.format(name, since_int, until_int))
+
+    # backfilled items have their own archive
+    archive_name = archive.backfill_name(name) if request.args.get('backfill') in ['1', 'true'] else name
+
+    def items():
+        # items are streamed as stored, a range is never loaded to memory at once
+        yield '{{"name": {}, "result": "ok", "transcript": ['.format(json.dumps(name))
+        for i, item in enumerate(archive.read_archive(archive_dir, archive_name, since_int, until_int)):
+            yield (', ' if i else '') + item.decode('utf-8')
+        yield ']}'
+
+    response = Response()
+
+    try:
+        if channel_cache.exists(name):
+            if archive.segments(archive_dir, archive_name):
+                response = Response(stream_with_context(items()), mimetype = 'application/json')
+
+            else:
+                application.logger.warn('Archive of channel {} not found'.format(name))
+                response.set_data(json.dumps({
+                    'name': name,
+                    'result': 'archive not found'
+                }))
+                response.mimetype = 'application/json'
+                response.status_code = 404
+
+        else:
+            application.logger.warn('Channel {} not registered'.format(name))
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'channel not registered'
+            }))
+            response.status_code = 404
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'name': name,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/backfill/<name>', methods=['POST'])
+def start_backfill(name):
+    application.logger.debug('Requested backfill of channel {}'.format(name))
+
+    response = Response()
+
+    if request.is_json:
+        src = request.json.get('src')
+        start = request.json.get('start', 0)
+    else:
+        src = request.values.get('src')
+        start = request.values.get('start', 0)
+
+    assert src is not None, 'Backfill of channel {} has no field src'.format(name)
+    start = int(start)
+
+    try:
+        if r.exists(name):
+            key = store.backfill_key(name)
+            if store.backfill_active(r, name):
+                application.logger.warn('Backfill of channel {} is already running'.format(name))
+                response.set_data(json.dumps({
+                    'name': name,
+                    'result': 'backfill already running'
+                }))
+                response.mimetype = 'application/json'
+                response.status_code = 409
+                return response
+
+            with r.pipeline() as pipe:
+                pipe.multi()
+                pipe.delete(key)
+                pipe.hmset(key, {
+                    'state': 'queued',
+                    'src': src,
+                    'start': start,
+                    'queued': int(time.time())
+                })
+                pipe.lpush(store.backfill_queue, json.dumps({
+                    'name': name,
+                    'src': src,
+                    'start': start
+                }))
+                store.publish_event(pipe, name, 'backfill')
+                pipe.execute()
+
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'queued'
+            }))
+            response.mimetype = 'application/json'
+            response.status_code = 200
+
+        else:
+            application.logger.warn('Channel {} not registered'.format(name))
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'channel not found'
+            }))
+            response.status_code = 404
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'name': name,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/backfill/<name>', methods=['GET'])
+def get_backfill(name):
+    application.logger.debug('Requested backfill progress of channel {}'.format(name))
+
+    response = Response()
+
+    try:
+        backfill = r.hgetall(store.backfill_key(name))
+        if backfill:
+            duration_sec = float(backfill.get('duration_sec') or 0)
+            done_sec = float(backfill.get('done_sec') or 0)
+            backfill.update({
+                'name': name,
+                'progress': round(min(1.0, done_sec / duration_sec), 3) if duration_sec else None,
+                'result': 'ok'
+            })
+            response.set_data(json.dumps(backfill))
+            response.mimetype = 'application/json'
+            response.status_code = 200
+
+        else:
+            application.logger.warn('Backfill of channel {} not found'.format(name))
+            response.set_data(json.dumps({
+                'name': name,
+                'result': 'backfill not found'
+            }))
+            response.mimetype = 'application/json'
+            response.status_code = 404
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'name': name,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
+@application.route('/api/search', methods=['GET'])
+def search_transcripts():
+    query = request.args.get('q', '')
+    channels = request.args.get('channels')
+    since = request.args.get('since')
+    since_int = int(since) if since is not None and since.isdigit() else None
+
+    application.logger.debug('Requested search of {} in channels {} since {}'.format(query, channels, since_int))
+
+    response = Response()
+
+    terms = store.entry_terms([query])
+    if not terms:
+        application.logger.warn('No terms found in query {}'.format(query))
+        response.set_data(json.dumps({
+            'query': query,
+            'result': 'no search terms'
+        }))
+        response.mimetype = 'application/json'
+        response.status_code = 400
+        return response
+
+    try:
+        names = channels.split(',') if channels else channel_cache.get_names()
+        results = store.search_transcripts(r, names, terms, since_int, search_limit)
+
+        response.set_data(store.json_dumps({
+            'query': query,
+            'transcript': results,
+            'result': 'ok',
+            'found': len(results)
+        }))
+        response.mimetype = 'application/json'
+        response.status_code = 200
+
+    except Exception as e:
+        application.logger.error('Unexpected exception: {0}'.format(e.message), exc_info=True)
+        response.set_data(json.dumps({
+            'query': query,
+            'result': 'unexpected error'
+        }))
+        response.status_code = 500
+
+    return response
+
+
 if __name__ == '__main__':
     application.run(
         debug = debug,
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import os
+import json
+import mmap
+import zlib
+import fcntl
+import bisect
+import shutil
+import struct
+
+# every channel has a directory of append-only segments named by the first timestamp,
+# <timestamp>.seg keeps records of 4-byte length and zlib compressed json item {timestamp: transcript},
+# <timestamp>.idx keeps (timestamp, offset) of every record of the segment
+record_header = struct.Struct('<I')
+index_record = struct.Struct('<II')
+
+
+def channel_dir(root, name):
+    return os.path.join(root, name)
+
+
+def segment_path(root, name, first, ext):
+    return os.path.join(channel_dir(root, name), '{}.{}'.format(first, ext))
+
+
+def backfill_name(name):
+    # backfilled items of a channel are archived apart from its live items, in a subdirectory
+    return os.path.join(name, 'backfill')
+
+
+def segments(root, name):
+    # first timestamps of segments in ascending order
+    path = channel_dir(root, name)
+    if not os.path.isdir(path):
+        return []
+    return sorted(int(entry[:-4]) for entry in os.listdir(path) if entry.endswith('.idx'))
+
+
+def delete_archive(root, name):
+    shutil.rmtree(channel_dir(root, name), ignore_errors = True)
+
+
+class ArchiveWriter(object):
+    # appends items evicted from the redis window of one channel, the live channel and its backfill
+    # may append at the same time, so every append takes a lock and starts at the end of the newest segment
+
+    def __init__(self, root, name, segment_bytes):
+        self.root = root
+        self.name = name
+        self.segment_bytes = segment_bytes
+        self.first = None
+        self.last = 0
+        self.size = 0
+        self.seg = None
+        self.idx = None
+
+    def open(self, first):
+        self.close()
+
+        path = channel_dir(self.root, self.name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        self.first = first
+        self.seg = open(segment_path(self.root, self.name, first, 'seg'), 'ab')
+        self.idx = open(segment_path(self.root, self.name, first, 'idx'), 'ab')
+        self.size = os.fstat(self.seg.fileno()).st_size
+
+        # timestamps of the index never go back, so it stays sorted for binary search
+        self.last = first
+        index = ArchiveIndex(self.idx.name)
+        if len(index):
+            self.last = max(first, index[len(index) - 1][0])
+        index.close()
+
+    def append(self, entries):
+        # entries are (timestamp, transcript) in order of the stream
+        if not entries:
+            return
+
+        while True:
+            found = segments(self.root, self.name)
+            if self.seg is None or not found or found[-1] != self.first:
+                self.open(found[-1] if found else entries[0][0])
+
+            # another writer may have started a new segment while this one waited for the lock
+            fcntl.flock(self.idx, fcntl.LOCK_EX)
+            found = segments(self.root, self.name)
+            if found and found[-1] == self.first:
+                break
+            fcntl.flock(self.idx, fcntl.LOCK_UN)
+
+        try:
+            self.size = os.fstat(self.seg.fileno()).st_size
+            index = ArchiveIndex(self.idx.name)
+            if len(index):
+                self.last = max(self.last, index[len(index) - 1][0])
+            index.close()
+
+            for timestamp, transcript in entries:
+                # segments are named by their first timestamp, so a new one needs a later timestamp
+                if self.size >= self.segment_bytes and max(timestamp, self.last) > self.first:
+                    lock = self.idx
+                    self.idx = None
+                    self.open(max(timestamp, self.last))
+                    fcntl.flock(self.idx, fcntl.LOCK_EX)
+                    lock.close()
+
+                data = zlib.compress(json.dumps({timestamp: transcript}).encode('utf-8'))
+                offset = self.size
+                self.seg.write(record_header.pack(len(data)) + data)
+                self.seg.flush()
+                self.size += record_header.size + len(data)
+
+                # the record is indexed after it's written, readers never see a partial record
+                self.last = max(self.last, timestamp)
+                self.idx.write(index_record.pack(self.last, offset))
+                self.idx.flush()
+        finally:
+            fcntl.flock(self.idx, fcntl.LOCK_UN)
+
+    def close(self):
+        if self.seg is not None:
+            self.seg.close()
+            self.seg = None
+        if self.idx is not None:
+            self.idx.close()
+            self.idx = None
+
+
+class ArchiveIndex(object):
+    # memory mapped index of a segment, a sequence of (timestamp, offset) for bisect
+
+    def __init__(self, path):
+        self.map = None
+        with open(path, 'rb') as f:
+            self.length = os.fstat(f.fileno()).st_size // index_record.size
+            if self.length:
+                self.map = mmap.mmap(f.fileno(), self.length * index_record.size, access = mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, i):
+        start = i * index_record.size
+        return index_record.unpack(self.map[start:start + index_record.size])
+
+    def find(self, timestamp):
+        # position of the first record at or after the timestamp
+        return bisect.bisect_left(self, (timestamp, 0))
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+
+def read_archive(root, name, since = None, until = None):
+    # yields serialized items one by one, only the index is mapped, records are read as they're yielded
+    firsts = segments(root, name)
+    start = max(0, bisect.bisect_right(firsts, since) - 1) if since is not None else 0
+
+    for first in firsts[start:]:
+        if until is not None and first > until:
+            return
+
+        index = ArchiveIndex(segment_path(root, name, first, 'idx'))
+        try:
+            with open(segment_path(root, name, first, 'seg'), 'rb') as f:
+                for i in range(index.find(since) if since is not None else 0, len(index)):
+                    timestamp, offset = index[i]
+                    if until is not None and timestamp > until:
+                        return
+
+                    f.seek(offset)
+                    size, = record_header.unpack(f.read(record_header.size))
+                    yield zlib.decompress(f.read(size))
+        finally:
+            index.close()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+import subprocess
+from collections import deque
+
+import numpy
+
+
+class AudioRing(object):
+
+    def __init__(self, slot_bytes, depth, policy = 'drop'):
+        assert depth > 0, 'Ring depth must be positive'
+        assert policy in ['drop', 'block'], 'Ring policy must be one of [drop, block] but found {}'.format(policy)
+
+        self.slot_bytes = slot_bytes
+        self.depth = depth
+        self.policy = policy
+
+        # one slot is being filled by the reader and one is held by the consumer
+        self.slots = depth + 2
+        self.buffer = bytearray(slot_bytes * self.slots)
+        self.view = memoryview(self.buffer)
+        self.lengths = [0] * self.slots
+        self.times = [0] * self.slots
+
+        # time when the slot returned by get was filled
+        self.time = None
+
+        self.free = deque(range(self.slots))
+        self.ready = deque()
+        self.held = None
+
+        # slot being filled by write and its filled length
+        self.writing = None
+        self.filled = 0
+
+        self.dropped = 0
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def slot(self, index):
+        start = index * self.slot_bytes
+        return self.view[start:start + self.slot_bytes]
+
+    def acquire(self, drop = False):
+        with self.cond:
+            while len(self.ready) >= self.depth:
+                if self.closed:
+                    return None
+                if self.policy == 'drop' or drop:
+                    self.free.append(self.ready.popleft())
+                    self.dropped += 1
+                else:
+                    self.cond.wait()
+
+            if self.closed:
+                return None
+            return self.free.popleft()
+
+    def commit(self, index, length):
+        with self.cond:
+            if length:
+                self.lengths[index] = length
+                self.times[index] = time.time()
+                self.ready.append(index)
+            else:
+                self.free.append(index)
+            self.cond.notify_all()
+
+    def write(self, data, drop = False):
+        # copies data into slots, returns False if the ring has been closed,
+        # drop makes a full ring drop the oldest audio whatever the policy is
+        offset = 0
+        while offset < len(data):
+            if self.writing is None:
+                self.writing = self.acquire(drop)
+                self.filled = 0
+                if self.writing is None:
+                    return False
+
+            n = min(len(data) - offset, self.slot_bytes - self.filled)
+            slot = self.slot(self.writing)
+            slot[self.filled:self.filled + n] = data[offset:offset + n]
+            self.filled += n
+            offset += n
+
+            if self.filled == self.slot_bytes:
+                self.commit(self.writing, self.filled)
+                self.writing = None
+
+        return True
+
+    def finish(self):
+        if self.writing is not None:
+            self.commit(self.writing, self.filled)
+            self.writing = None
+        self.close()
+
+    def get(self):
+        # returned view stays valid until the next call of get
+        with self.cond:
+            if self.held is not None:
+                self.free.append(self.held)
+                self.held = None
+                self.cond.notify_all()
+
+            while not self.ready:
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+            self.held = self.ready.popleft()
+            self.time = self.times[self.held]
+            return self.slot(self.held)[:self.lengths[self.held]]
+
+    def qsize(self):
+        with self.cond:
+            return len(self.ready)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+def frame_energy(samples, frame_samples):
+    count = len(samples) // frame_samples
+    frames = samples[:count * frame_samples].reshape(count, frame_samples).astype(numpy.float32)
+    rms = numpy.sqrt(numpy.mean(frames * frames, axis = 1))
+    return 20 * numpy.log10(numpy.maximum(rms, 1.0) / 32768.0)
+
+
+class SpeechGate(object):
+
+    def __init__(self, sample_rate, threshold, frame_ms, hangover_ms):
+        self.threshold = threshold
+        self.frame_samples = int(sample_rate * frame_ms / 1000)
+        self.hangover = int(hangover_ms / frame_ms)
+        # frames passed since the last frame with speech, carried between calls
+        self.silent = self.hangover + 1
+
+    def filter(self, pcm):
+        # returns audio with speech frames only (None if there is no speech) and number of kept samples
+        # numpy of python 2 can't read memoryviews of ring slots and segments
+        samples = numpy.frombuffer(pcm.tobytes() if isinstance(pcm, memoryview) else pcm, dtype = '<i2')
+        energy = frame_energy(samples, self.frame_samples)
+        count = len(energy)
+
+        if count:
+            index = numpy.arange(count)
+            last = numpy.maximum.accumulate(numpy.where(energy > self.threshold, index, -self.silent - 1))
+            keep = index - last <= self.hangover
+            self.silent = count - 1 - int(last[-1])
+        else:
+            keep = numpy.zeros(0, dtype = bool)
+
+        tail = samples[count * self.frame_samples:]
+        keep_tail = bool(keep[-1]) if count else self.silent <= self.hangover
+
+        if keep.all() and (keep_tail or not len(tail)):
+            return samples.tobytes(), len(samples)
+        if not keep.any() and not (keep_tail and len(tail)):
+            return None, 0
+
+        frames = samples[:count * self.frame_samples].reshape(count, self.frame_samples)[keep]
+        speech = frames.ravel()
+        if keep_tail:
+            speech = numpy.concatenate((speech, tail))
+        return speech.tobytes(), len(speech)
+
+
+class Segmenter(object):
+    # collects audio and cuts it into segments in the quietest frame of the window around the target duration,
+    # so words are not split between chunks
+
+    def __init__(self, sample_rate, target_sec, min_sec, max_sec, lookahead_sec, frame_ms):
+        bytes_per_sec = sample_rate * 2
+        self.frame_samples = int(sample_rate * frame_ms / 1000)
+        self.max_bytes = int(max_sec * bytes_per_sec) // 2 * 2
+        self.start = min(int(max(min_sec, target_sec - lookahead_sec) * bytes_per_sec) // 2 * 2, self.max_bytes)
+        self.end = max(min(int((target_sec + lookahead_sec) * bytes_per_sec) // 2 * 2, self.max_bytes), self.start)
+        self.buffer = bytearray()
+
+    def push(self, pcm):
+        # returns list of complete segments
+        self.buffer.extend(pcm)
+
+        segments = []
+        while self.end and len(self.buffer) >= self.end:
+            cut = self.cut()
+            segments.append(memoryview(bytes(self.buffer[:cut])))
+            del self.buffer[:cut]
+        return segments
+
+    def flush(self):
+        # returns the rest of audio as the last segment, None if nothing is left
+        if not self.buffer:
+            return None
+        segment = memoryview(bytes(self.buffer))
+        del self.buffer[:]
+        return segment
+
+    def cut(self):
+        # offset of the middle of the quietest frame of the window
+        window = numpy.frombuffer(bytes(self.buffer[self.start:self.end]), dtype = '<i2')
+        energy = frame_energy(window, self.frame_samples)
+        if not len(energy):
+            return self.end
+        return self.start + (int(numpy.argmin(energy)) * self.frame_samples + self.frame_samples // 2) * 2
+
+
+encoder_formats = {
+    'flac': ['-acodec', 'flac', '-f', 'flac'],
+    # short ogg pages keep latency of streaming low
+    'ogg_opus': ['-acodec', 'libopus', '-b:a', '32k', '-page_duration', '100000', '-f', 'ogg']
+}
+
+
+def encoder_process(encoding, sample_rate):
+    assert encoding in encoder_formats, 'Encoding must be one of {} but found {}'.format(
+        sorted(encoder_formats.keys()), encoding)
+
+    args = [
+        'ffmpeg',
+        '-loglevel', 'error',
+        '-f', 's16le',
+        '-ar', str(sample_rate),
+        '-ac', '1',
+        '-i', 'pipe:'
+    ] + encoder_formats[encoding] + [
+        'pipe:'
+    ]
+    return subprocess.Popen(args, stdin = subprocess.PIPE, stdout = subprocess.PIPE)
+
+
+def encode_chunk(pcm, encoding, sample_rate):
+    # every chunk is a complete stream with its own header
+    process = encoder_process(encoding, sample_rate)
+    data, error = process.communicate(pcm)
+    return data
+
+
+def encode_stream(audio, encoding, sample_rate, read_bytes = 4096):
+    # feeds pcm of the audio generator into one encoder and yields encoded data as soon as it's produced
+    process = encoder_process(encoding, sample_rate)
+
+    def feed():
+        try:
+            for chunk in audio:
+                process.stdin.write(chunk)
+                process.stdin.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            process.stdin.close()
+
+    feeder = threading.Thread(target = feed, name = 'encoder_feeder_{}'.format(process.pid))
+    feeder.daemon = True
+    feeder.start()
+
+    try:
+        while True:
+            data = os.read(process.stdout.fileno(), read_bytes)
+            if not data:
+                break
+            yield data
+    finally:
+        if process.poll() is None:
+            process.kill()
+        process.wait()
@@ -5,30 +5,96 @@ import sys
 import json
 import time
 import redis
+import random
+import socket
 import base64
 import logging
+import threading
+from collections import deque
+from contextlib import contextmanager
 
+import zlib
 import subprocess
-from multiprocessing import Process
+from multiprocessing import Process, Queue, Pool, cpu_count
 
-from google.cloud import speech
-from google.cloud.speech import enums
-from google.cloud.speech import types
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
 
 import config
+import scribbled_recognizer
+import scribbled_metrics as metrics
+from scribbled_audio import AudioRing, SpeechGate, Segmenter, encode_chunk, encode_stream
+from scribbled_archive import ArchiveWriter, backfill_name
+from scribbled_scheduler import Scheduler, Rejected
+import scribbled_store as store
 
 channels = getattr(config, 'channels')
 
 sample_rate = getattr(config, 'sample_rate')
 chunk_sec = getattr(config, 'chunk_sec')
+min_segment_sec = getattr(config, 'min_segment_sec')
+max_segment_sec = getattr(config, 'max_segment_sec')
+segment_lookahead_sec = getattr(config, 'segment_lookahead_sec')
 chunk_set_len = getattr(config, 'chunk_set_len')
 offset_sec = getattr(config, 'offset_sec')
+ffmpeg_stall_sec = getattr(config, 'ffmpeg_stall_sec')
+ffmpeg_backoff_sec = getattr(config, 'ffmpeg_backoff_sec')
+ffmpeg_backoff_max_sec = getattr(config, 'ffmpeg_backoff_max_sec')
 transcript_set_len = getattr(config, 'transcript_set_len')
+archive = getattr(config, 'archive')
+archive_segment_bytes = getattr(config, 'archive_segment_bytes')
 sleep_sec = getattr(config, 'sleep_sec')
-
-chunk_bytes = int(sample_rate * chunk_sec)
+log_level = getattr(config, 'log_level')
+metrics_port = getattr(config, 'metrics_port')
+reconcile_sec = getattr(config, 'reconcile_sec')
+
+engine = getattr(config, 'engine')
+engine_workers = getattr(config, 'engine_workers') or cpu_count()
+
+backfill_jobs = getattr(config, 'backfill_jobs')
+backfill_workers = getattr(config, 'backfill_workers') or cpu_count()
+backfill_priority = getattr(config, 'backfill_priority')
+backfill_retries = getattr(config, 'backfill_retries')
+backfill_set_len = getattr(config, 'backfill_set_len')
+
+node_id = getattr(config, 'node_id') or socket.gethostname()
+node_capacity = getattr(config, 'node_capacity')
+lease_ms = getattr(config, 'lease_ms')
+heartbeat_sec = getattr(config, 'heartbeat_sec')
+
+streaming = getattr(config, 'streaming')
+stream_frame_sec = getattr(config, 'stream_frame_sec')
+stream_session_sec = getattr(config, 'stream_session_sec')
+interim_results = getattr(config, 'interim_results')
+recognizer_backend = getattr(config, 'recognizer_backend')
+encoding = getattr(config, 'encoding')
+recognizer_url = getattr(config, 'recognizer_url')
+recognizer_utterance_sec = getattr(config, 'recognizer_utterance_sec')
+scheduler = getattr(config, 'scheduler')
+scheduler_concurrency = getattr(config, 'scheduler_concurrency')
+scheduler_requests_per_sec = getattr(config, 'scheduler_requests_per_sec')
+scheduler_audio_sec_per_sec = getattr(config, 'scheduler_audio_sec_per_sec')
+scheduler_burst_sec = getattr(config, 'scheduler_burst_sec')
+scheduler_max_wait_sec = getattr(config, 'scheduler_max_wait_sec')
+scheduler_poll_sec = getattr(config, 'scheduler_poll_sec')
+scheduler_hold_sec = getattr(config, 'scheduler_hold_sec')
+ring_sec = getattr(config, 'ring_sec')
+ring_policy = getattr(config, 'ring_policy')
+ring_report_sec = getattr(config, 'ring_report_sec')
+vad_threshold = getattr(config, 'vad_threshold')
+vad_frame_ms = getattr(config, 'vad_frame_ms')
+vad_hangover_ms = getattr(config, 'vad_hangover_ms')
+
+chunk_overlap_sec = getattr(config, 'chunk_overlap_sec')
+stitch_words = getattr(config, 'stitch_words')
+
+chunk_overlap_bytes = int(sample_rate * 2 * chunk_overlap_sec)
+stream_frame_bytes = int(sample_rate * 2 * stream_frame_sec)
 
 work_dir = getattr(config, 'work_dir')
+archive_dir = getattr(config, 'archive_dir') or os.path.join(work_dir, 'archive')
 
 redis_host = getattr(config, 'redis_host')
 redis_port = getattr(config, 'redis_port')
@@ -38,18 +104,55 @@ r.ping()
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(
-    level = logging.DEBUG,
+    level = getattr(logging, log_level),
     format = '%(asctime)s - %(levelname)s - %(message)s'
 )
 
 
 def update_pid(name, pid = 0):
     logger.debug('Updating pid for channel {} to {}'.format(name, pid))
-    r.hset(name, 'pid', pid)
+    with r.pipeline() as pipe:
+        pipe.hset(name, 'pid', pid)
+        store.publish_event(pipe, name, 'pid')
+        pipe.execute()
 
 def update_pid_ffmpeg(name, pid = 0):
     logger.debug('Updating ffmpeg pid for channel {} to {}'.format(name, pid))
-    r.hset(name, 'pid_ffmpeg', pid)
+    with r.pipeline() as pipe:
+        pipe.hset(name, 'pid_ffmpeg', pid)
+        store.publish_event(pipe, name, 'pid')
+        pipe.execute()
+
+
+def normalize_word(word):
+    return ''.join(c for c in word.lower() if c.isalnum())
+
+
+def stitch_transcript(previous, transcript, skip = 2):
+    # removes words at the beginning of transcript which repeat the end of previous words,
+    # first words of transcript may be cut by the chunk boundary and are allowed to differ
+    words = [normalize_word(word) for text in transcript for word in text.split()]
+    tail = [normalize_word(word) for word in previous[-stitch_words:]]
+
+    drop = 0
+    for offset in range(min(skip, len(words)) + 1):
+        for length in range(min(len(tail), len(words) - offset), 0 if offset == 0 else 1, -1):
+            if words[offset:offset + length] == tail[-length:]:
+                drop = offset + length
+                break
+        if drop:
+            break
+
+    stitched = []
+    for text in transcript:
+        text_words = text.split()
+        if drop >= len(text_words):
+            drop -= len(text_words)
+            continue
+        stitched.append(' '.join(text_words[drop:]) if drop else text)
+        drop = 0
+
+    return stitched
 
 
 def dummy_loop(name, src, lang, creds):
@@ -94,114 +197,756 @@ def dummy_loop(name, src, lang, creds):
 
     time.sleep(sleep_sec)
 
-def channel_loop(name, src, lang, creds):
-    def ffmpeg_process(source):
-        logger.debug('Starting ffmpeg process {}'.format(source))
-        args = [
-            'ffmpeg',
-            '-re',
-            '-itsoffset', '-' + str(offset_sec),
-            '-i', source,
-            '-f', 's16le',
-            '-ac', '1',
-            '-acodec', 'pcm_s16le',
-            '-ar', str(sample_rate),
-            'pipe:'
-        ]
-        logger.debug('ffmpeg string: {}'.format(args))
-        return subprocess.Popen(args, stdout=subprocess.PIPE)
+def ffmpeg_input(source):
+    # lavfi:<filtergraph> sources generate synthetic audio, e.g. lavfi:sine=frequency=440
+    if source.startswith('lavfi:'):
+        return ['-f', 'lavfi', '-i', source[len('lavfi:'):]]
+    return ['-i', source]
+
+
+def ffmpeg_process(source, realtime = True):
+    # recorded sources of backfill are read as fast as ffmpeg decodes them
+    logger.debug('Starting ffmpeg process {}'.format(source))
+    args = [
+        'ffmpeg'
+    ] + (['-re', '-itsoffset', '-' + str(offset_sec)] if realtime else []) + ffmpeg_input(source) + [
+        '-f', 's16le',
+        '-ac', '1',
+        '-acodec', 'pcm_s16le',
+        '-ar', str(sample_rate),
+        'pipe:'
+    ]
+    logger.debug('ffmpeg string: {}'.format(args))
+    return subprocess.Popen(args, stdout=subprocess.PIPE)
+
+
+class Decoder(object):
+    # one ffmpeg process per source, its audio is copied to rings of all subscribed channels,
+    # ffmpeg is restarted in place, so channels keep their rings and recognizer sessions
+
+    def __init__(self, src):
+        self.src = src
+        self.subscribers = []
+        self.lock = threading.Lock()
+        self.stopped = False
+        # time since the reader waits for ffmpeg, None while it's writing to rings,
+        # so a ring blocked by a slow consumer doesn't look like a stalled ffmpeg
+        self.waiting_since = time.time()
+        self.process = ffmpeg_process(src)
+        self.thread = threading.Thread(
+            target = self.run,
+            name = 'decoder_{}'.format(self.process.pid)
+        )
+        self.thread.daemon = True
+        self.watchdog = threading.Thread(
+            target = self.watch,
+            name = 'decoder_watchdog_{}'.format(self.process.pid)
+        )
+        self.watchdog.daemon = True
+
+    def start(self):
+        self.thread.start()
+        self.watchdog.start()
+
+    def read(self, view):
+        while True:
+            self.waiting_since = time.time()
+            n = self.process.stdout.readinto(view)
+            self.waiting_since = None
+            if not n:
+                logger.warn('End of stream {}'.format(self.src))
+                return
+
+            with self.lock:
+                subscribers = list(self.subscribers)
+            # ring_policy block holds the source only for its single channel,
+            # a slow channel of a shared source drops its own audio instead of stalling the others
+            drop = len(subscribers) > 1
+            for name, ring in subscribers:
+                ring.write(view[:n], drop)
+
+    def run(self):
+        buffer = bytearray(stream_frame_bytes)
+        view = memoryview(buffer)
+        attempts = 0
+
+        while True:
+            started = time.time()
+            self.read(view)
+            self.process.wait()
+            if self.stopped:
+                break
+
+            if time.time() - started > ffmpeg_backoff_max_sec:
+                attempts = 0
+            delay = min(ffmpeg_backoff_max_sec, ffmpeg_backoff_sec * 2 ** attempts) * random.uniform(0.5, 1.5)
+            attempts += 1
+
+            logger.warn('ffmpeg process of {} exited with code {}, restarting in {:.1f} sec'.format(
+                self.src, self.process.returncode, delay)
+            )
+            time.sleep(delay)
+
+            with self.lock:
+                if self.stopped:
+                    break
+                self.process = ffmpeg_process(self.src)
+                subscribers = list(self.subscribers)
+
+            metrics.ffmpeg_restarts.labels(self.src).inc()
+            for name, ring in subscribers:
+                update_pid_ffmpeg(name, self.process.pid)
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for name, ring in subscribers:
+            ring.finish()
+
+    def watch(self):
+        while not self.stopped:
+            time.sleep(1)
+            process = self.process
+            waiting_since = self.waiting_since
+            stalled = waiting_since is not None and time.time() - waiting_since > ffmpeg_stall_sec
+            if stalled and process.poll() is None:
+                logger.warn('No audio from ffmpeg process of {} for {} sec, killing it'.format(
+                    self.src, ffmpeg_stall_sec)
+                )
+                process.kill()
+
+    def is_alive(self):
+        return self.thread.is_alive()
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            process = self.process
+
+        if process.poll() is None:
+            logger.info('Stopping ffmpeg process of {}'.format(self.src))
+            process.kill()
+        process.wait()
+
+
+decoders = {}
+decoders_lock = threading.Lock()
+
+
+def acquire_decoder(src, name, ring):
+    key = (src, offset_sec)
+    with decoders_lock:
+        decoder = decoders.get(key)
+        if decoder is None or not decoder.is_alive():
+            decoder = Decoder(src)
+            decoder.start()
+            decoders[key] = decoder
+        else:
+            logger.debug('Sharing ffmpeg process {} of {}'.format(decoder.process.pid, src))
+
+        with decoder.lock:
+            decoder.subscribers.append((name, ring))
+        return decoder
+
+
+def release_decoder(decoder, ring):
+    key = (decoder.src, offset_sec)
+    with decoders_lock:
+        with decoder.lock:
+            decoder.subscribers = [subscriber for subscriber in decoder.subscribers if subscriber[1] is not ring]
+            subscribers = len(decoder.subscribers)
+
+        if not subscribers:
+            decoder.stop()
+            if decoders.get(key) is decoder:
+                del decoders[key]
+
+
+def channel_loop(name, src, lang, creds, stop = None):
+    @contextmanager
+    def recognition_slot(audio_sec, hold_sec):
+        # requests of all channels go through the shared scheduler to stay within limits of credentials,
+        # yields usage where a request of unknown length puts audio_sec it has sent to be charged on release
+        if stop is not None and stop.is_set():
+            raise Rejected('Channel is stopped')
+
+        usage = {'audio_sec': 0}
+        if channel_scheduler is None:
+            yield usage
+            return
+
+        try:
+            ticket, waited = channel_scheduler.acquire(audio_sec, hold_sec, stop)
+        except Rejected:
+            if stop is None or not stop.is_set():
+                metrics.scheduler_rejected.labels(name).inc()
+            raise
+
+        metrics.scheduler_wait.labels(name).observe(waited)
+        try:
+            yield usage
+        finally:
+            channel_scheduler.release(ticket, usage['audio_sec'])
 
     def transcript_chunk(data, lang):
         logger.debug('Transcription of incoming set of {} chunks'.format(len(data)))
 
-        requests = (types.StreamingRecognizeRequest(audio_content = chunk)
-            for chunk in data)
+        audio_sec = sum(len(chunk) for chunk in data) / (sample_rate * 2.0)
+        if channel_encoding != 'linear16':
+            data = [encode_chunk(b''.join(data), channel_encoding, sample_rate)]
+
+        try:
+            with recognition_slot(audio_sec, scheduler_hold_sec):
+                metrics.upload_bytes.labels(name).inc(sum(len(chunk) for chunk in data))
+                with metrics.recognize_latency.labels(name).time():
+                    return recognizer.recognize(data)
+        except Rejected as e:
+            logger.warn('Skipping audio of channel {}: {}'.format(name, e))
+            return []
+
+    def audio_ring(slot_bytes):
+        depth = max(1, int(ring_sec * sample_rate * 2 / slot_bytes))
+        logger.debug('Creating ring of {} slots of {} bytes for channel {}'.format(depth, slot_bytes, name))
+        return AudioRing(slot_bytes, depth, ring_policy)
+
+    def report_state(ring, state):
+        now = time.time()
+        if now - state.get('reported', 0) < ring_report_sec:
+            return
+        state['reported'] = now
+
+        depth = ring.qsize()
+        if ring.dropped:
+            logger.warn('Channel {} ring depth {}, dropped {} slots'.format(name, depth, ring.dropped))
+
+        metrics.ring_depth.labels(name).set(depth)
+        metrics.ring_dropped.labels(name).inc(ring.dropped - state.get('dropped', 0))
+        state['dropped'] = ring.dropped
+
+        with metrics.redis_latency.labels('report').time():
+            with r.pipeline() as pipe:
+                pipe.hset(name, 'queue_depth', depth)
+                pipe.hset(name, 'queue_dropped', ring.dropped)
+                pipe.hincrbyfloat(name, 'vad_sent_sec', state.pop('sent', 0) / float(sample_rate))
+                pipe.hincrbyfloat(name, 'vad_skipped_sec', state.pop('skipped', 0) / float(sample_rate))
+                pipe.execute()
+
+    def read_audio(ring, state):
+        with metrics.chunk_wait.labels(name).time():
+            data = ring.get()
+
+        if data is not None:
+            metrics.audio_bytes.labels(name).inc(len(data))
+            state['audio_time'] = ring.time
+            report_state(ring, state)
+        return data
+
+    def gate_speech(data, state):
+        total = len(data) // 2
+        if gate is None:
+            speech, sent = data.tobytes(), total
+        else:
+            speech, sent = gate.filter(data)
+
+        state['sent'] = state.get('sent', 0) + sent
+        state['skipped'] = state.get('skipped', 0) + total - sent
+        return speech
+
+    def transcript_chunks(ring):
+        chunk_set = deque(maxlen = chunk_set_len)
+        context = None
+        words = []
+        state = {}
+
+        min_sec = float(r.hget(name, 'min_segment_sec') or min_segment_sec)
+        max_sec = float(r.hget(name, 'max_segment_sec') or max_segment_sec)
+        logger.debug('Cutting audio of channel {} to chunks of {} to {} sec'.format(name, min_sec, max_sec))
+        segmenter = Segmenter(sample_rate, chunk_sec, min_sec, max_sec, segment_lookahead_sec, vad_frame_ms)
+
+        while True:
+            data = read_audio(ring, state)
+            if data is None:
+                logger.warn('End of stream {}'.format(name))
+                break
+
+            for chunk in segmenter.push(data):
+                logger.debug('Reading chunk of {} bytes'.format(len(chunk)))
+                speech = gate_speech(chunk, state)
+                if speech is None:
+                    logger.debug('No speech found in chunk of channel {}, skipping'.format(name))
+                    context = None
+                    continue
+
+                if chunk_overlap_bytes:
+                    logger.debug('Transcription of chunk with {} bytes of context'.format(
+                        len(context) if context else 0)
+                    )
+                    transcript = transcript_chunk([context, speech] if context else [speech], lang)
+                    if context:
+                        transcript = stitch_transcript(words, transcript)
+                    context = speech[-chunk_overlap_bytes:]
+
+                else:
+                    chunk_set.append(speech)
+
+                    logger.debug('Transcription current set of {} chunks'.format(len(chunk_set)))
+                    transcript = transcript_chunk(chunk_set, lang)
+
+                if len(transcript):
+                    words = ' '.join(transcript).split()[-stitch_words:]
+                    commit_transcript(transcript, state['audio_time'])
+
+    def next_speech(ring, state):
+        # skips gated silence, returns None at the end of stream
+        while True:
+            data = read_audio(ring, state)
+            if data is None:
+                logger.warn('End of stream {}'.format(name))
+                state['eos'] = True
+                return None
+
+            speech = gate_speech(data, state)
+            if speech is not None:
+                return speech
+
+    def stream_requests(ring, state, speech):
+        deadline = time.time() + stream_session_sec
+        while speech is not None:
+            state['sent_bytes'] += len(speech)
+            yield speech
+            if time.time() >= deadline:
+                break
+            speech = next_speech(ring, state)
+
+        if state['eos']:
+            return
+
+        logger.debug('Recognition session of channel {} reached {} sec, rotating'.format(
+            name, stream_session_sec)
+        )
+
+    def count_upload(audio):
+        for chunk in audio:
+            metrics.upload_bytes.labels(name).inc(len(chunk))
+            yield chunk
+
+    def transcript_stream(ring):
+        state = {'eos': False}
+
+        while not state['eos']:
+            # a session is opened on speech, so gated silence doesn't open sessions just to time them out
+            speech = next_speech(ring, state)
+            if speech is None:
+                break
+
+            logger.debug('Opening recognition session for channel {}'.format(name))
+            state['sent_bytes'] = 0
+            audio = stream_requests(ring, state, speech)
+            if channel_encoding != 'linear16':
+                # every session gets its own encoder, so it starts with a stream header
+                audio = encode_stream(audio, channel_encoding, sample_rate)
+
+            try:
+                # a session holds its slot until it's rotated and is charged for the audio it has sent
+                with recognition_slot(0, stream_session_sec + scheduler_hold_sec) as usage:
+                    try:
+                        for is_final, text in recognizer.stream(count_upload(audio)):
+                            if is_final:
+                                commit_transcript([text], state['audio_time'])
+                            else:
+                                publish_interim([text])
+                    finally:
+                        usage['audio_sec'] = state['sent_bytes'] / (sample_rate * 2.0)
+
+            except Rejected as e:
+                logger.warn('Skipping audio of channel {}: {}'.format(name, e))
+
+            except Exception as e:
+                # the session times out when the gate holds back audio or ffmpeg restarts, a new one is opened
+                if 'timeout' in str(e).lower():
+                    logger.info('Recognition session of channel {} timed out: {}'.format(name, e))
+                else:
+                    logger.error('Recognition session of channel {} failed: {}'.format(name, e))
+                    time.sleep(sleep_sec)
+
+    def commit_transcript(transcript, audio_time):
+        timestamp = int(time.time())
 
-        responses = client.streaming_recognize(streaming_config, requests)
+        logger.debug('Updating channel {} transcription'.format(name))
+        with metrics.redis_latency.labels('commit').time():
+            store.append_transcript(r, name, timestamp, transcript, transcript_set_len, archive_writer)
 
-        transcript = []
+        metrics.commit_lag.labels(name).observe(time.time() - audio_time)
 
-        for response in responses:
-            for result in response.results:
-                transcript.append(result.alternatives[0].transcript)
+    def publish_interim(transcript):
+        r.publish(name + '|interim', json.dumps({
+            'name': name,
+            'timestamp': int(time.time()),
+            'transcript': transcript
+        }))
 
-        return transcript
+    def stop_watcher(ring):
+        stop.wait()
+        logger.info('Closing audio ring of stopped channel {}'.format(name))
+        ring.close()
 
 
-    os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = creds
+    channel_encoding = r.hget(name, 'encoding') or encoding
+    logger.debug('Sending audio of channel {} as {}'.format(name, channel_encoding))
 
-    client = speech.SpeechClient()
-    config = types.RecognitionConfig(
-        encoding = enums.RecognitionConfig.AudioEncoding.LINEAR16,
-        sample_rate_hertz = int(sample_rate),
-        language_code = lang,
-        max_alternatives = 1
-    )
-    streaming_config = types.StreamingRecognitionConfig(
-        config = config
-        # config = config,
-        # interim_results = True
+    recognizer = scribbled_recognizer.create(
+        recognizer_backend, creds, lang, sample_rate,
+        interim_results = interim_results,
+        encoding = channel_encoding,
+        url = recognizer_url,
+        utterance_sec = recognizer_utterance_sec
     )
 
-    chunk_set = []
-    if r.hexists(name, 'transcript'):
-        logger.debug('Loading transcript of channel {} into current set'.format(name))
-        transcript_set = json.loads(r.hget(name, 'transcript'))
+    if scheduler:
+        channel_scheduler = Scheduler(
+            r, scribbled_recognizer.fingerprint(creds), int(r.hget(name, 'priority') or 0),
+            scheduler_concurrency, scheduler_requests_per_sec, scheduler_audio_sec_per_sec, scheduler_burst_sec,
+            scheduler_max_wait_sec, scheduler_poll_sec
+        )
     else:
-        transcript_set = []
+        channel_scheduler = None
 
-    process = ffmpeg_process(src)
+    threshold = r.hget(name, 'vad_threshold') or vad_threshold
+    if threshold is not None:
+        logger.debug('Gating audio of channel {} with threshold {} dBFS'.format(name, threshold))
+        gate = SpeechGate(sample_rate, float(threshold), vad_frame_ms, vad_hangover_ms)
+    else:
+        gate = None
 
-    update_pid_ffmpeg(name, process.pid)
+    archive_writer = ArchiveWriter(archive_dir, name, archive_segment_bytes) if archive else None
 
-    while True:
+    # the segmenter collects chunks from short slots, so the ring holds frames in both modes
+    ring = audio_ring(stream_frame_bytes)
+    decoder = acquire_decoder(src, name, ring)
 
-        chunk = process.stdout.read(chunk_bytes)
-        if not chunk:
-            logger.warn('End of stream {}'.format(name))
-            break
+    update_pid_ffmpeg(name, decoder.process.pid)
+
+    if stop is not None:
+        watcher = threading.Thread(
+            target = stop_watcher,
+            name = 'stop_watcher_{}'.format(name),
+            args = (ring,)
+        )
+        watcher.daemon = True
+        watcher.start()
+
+    if streaming:
+        transcript_stream(ring)
+    else:
+        transcript_chunks(ring)
+
+    logger.error('Terminating channel {}'.format(name))
+    release_decoder(decoder, ring)
+    if archive_writer is not None:
+        archive_writer.close()
 
-        logger.debug('Reading chunk of {} bytes'.format(len(chunk)))
-        chunk_set.append(chunk)
+    if stop is not None:
+        if stop.is_set():
+            return
+        stop.set()
 
-        while len(chunk_set) > chunk_set_len:
-            logger.debug('Chunk set length {} larger then limit {}, popping oldest item'.format(
-                len(chunk_set), chunk_set_len)
+    update_pid_ffmpeg(name)
+
+    time.sleep(sleep_sec)
+
+
+def worker_loop(index, commands):
+    def start_channel(name, src, lang, creds):
+        # a thread blocked in a recognition request exits later, the channel waits for it,
+        # so two threads never commit transcripts of the same channel
+        if any(thread.is_alive() for thread in stopping.get(name, [])):
+            logger.info('Channel {} in worker {} waits for its stopped thread'.format(name, index))
+            pending[name] = (src, lang, creds)
+            return
+
+        pending.pop(name, None)
+        logger.info('Starting thread for channel {} in worker {}'.format(name, index))
+        stop = threading.Event()
+        thread = threading.Thread(
+            target = channel_loop,
+            name = 'channel_loop_{}'.format(name),
+            args = (name, src, lang, creds, stop)
+        )
+        thread.daemon = True
+        thread.start()
+        channels[name] = (thread, stop, (src, lang, creds))
+
+    def stop_channel(name):
+        # the thread isn't joined, so commands of other channels don't wait for it
+        logger.info('Stopping thread for channel {} in worker {}'.format(name, index))
+        thread, stop, args = channels.pop(name)
+        stop.set()
+        stopping.setdefault(name, []).append(thread)
+
+    def check_stopping():
+        for name, threads in list(stopping.items()):
+            stopping[name] = [thread for thread in threads if thread.is_alive()]
+            if stopping[name]:
+                continue
+
+            logger.debug('Thread of stopped channel {} in worker {} has exited'.format(name, index))
+            del stopping[name]
+            if name in pending:
+                start_channel(name, *pending[name])
+
+    channels = {}
+    stopping = {}
+    pending = {}
+
+    while True:
+        try:
+            # channels waiting for their stopped threads are checked more often
+            command = commands.get(timeout = 0.1 if pending else sleep_sec)
+        except Empty:
+            command = None
+
+        if command is not None:
+            action, name = command[0], command[1]
+            pending.pop(name, None)
+            if name in channels:
+                stop_channel(name)
+            if action == 'start':
+                start_channel(name, *command[2:])
+
+        check_stopping()
+
+        for name, (thread, stop, args) in list(channels.items()):
+            if not thread.is_alive():
+                logger.warn('Thread of channel {} in worker {} is not alive'.format(name, index))
+                start_channel(name, *args)
+
+
+class Worker(object):
+
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.commands = None
+
+    def send(self, command):
+        if self.process is None or not self.process.is_alive():
+            if self.process is not None:
+                logger.warn('Worker {} is not alive'.format(self.index))
+                metrics.process_dead(self.process.pid)
+
+            logger.info('Starting worker {}'.format(self.index))
+            self.commands = Queue()
+            self.process = Process(
+                target = worker_loop,
+                name = 'worker_loop_{}'.format(self.index),
+                args = (self.index, self.commands)
             )
-            chunk_set.pop(0)
+            self.process.start()
 
-        logger.debug('Transcription current set of {} chunks'.format(len(chunk_set)))
-        transcript = transcript_chunk(chunk_set, lang)
+        self.commands.put(command)
 
-        timestamp = int(time.time())
 
-        if len(transcript):
-            logger.debug('Updating channel {} transcription'.format(name))
-            transcript_set.append({
-                timestamp: transcript
-            })
-            # transcript_set.append({
-            #     'timestamp': timestamp,
-            #     'data': transcript
-            # })
-
-            while len(transcript_set) > transcript_set_len:
-                logger.debug('Transcript set length {} larger then limit {}, popping oldest item'.format(
-                    len(transcript_set), transcript_set_len)
-                )
-                transcript_set.pop(0)
+class WorkerChannel(object):
+    # quacks like multiprocessing.Process for control_channel
 
-            r.hset(name, 'transcript', json.dumps(transcript_set))
+    def __init__(self, worker, name, src, lang, creds):
+        self.worker = worker
+        self.name = name
+        self.args = (src, lang, creds)
+        self.process = None
 
+    def start(self):
+        self.worker.send(('start', self.name) + self.args)
+        self.process = self.worker.process
 
-    logger.error('Terminating channel {}'.format(name))
-    if process.poll() is None:
-        process.kill()
-    process.wait()
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
 
-    update_pid_ffmpeg(name)
+    def terminate(self):
+        if self.worker.process is self.process:
+            self.worker.send(('stop', self.name))
+
+    @property
+    def pid(self):
+        return self.process.pid
 
-    time.sleep(sleep_sec)
+
+def channel_process(name, src, lang, creds):
+    if engine == 'thread':
+        # channels of the same source share ffmpeg process within a worker
+        worker = workers[zlib.crc32(src) % len(workers)]
+        return WorkerChannel(worker, name, src, lang, creds)
+
+    return Process(
+        target = channel_loop,
+        name = 'channel_loop_{}'.format(name),
+        args = (name, src, lang, creds)
+    )
+
+
+def probe_duration(source):
+    # duration of a recorded source in seconds, None if ffprobe can't tell
+    try:
+        output = subprocess.check_output(
+            ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0'] + ffmpeg_input(source)
+        )
+        return float(output.strip())
+    except Exception as e:
+        logger.warn('Could not get duration of {}: {}'.format(source, e))
+        return None
+
+
+def backfill_init(creds, lang, channel_encoding):
+    # every process of the pool has its own recognizer
+    global backfill_recognizer, backfill_scheduler, backfill_encoding
+
+    backfill_encoding = channel_encoding
+    backfill_recognizer = scribbled_recognizer.create(
+        recognizer_backend, creds, lang, sample_rate,
+        encoding = channel_encoding,
+        url = recognizer_url,
+        utterance_sec = recognizer_utterance_sec
+    )
+    if scheduler:
+        backfill_scheduler = Scheduler(
+            r, scribbled_recognizer.fingerprint(creds), backfill_priority,
+            scheduler_concurrency, scheduler_requests_per_sec, scheduler_audio_sec_per_sec, scheduler_burst_sec,
+            scheduler_max_wait_sec, scheduler_poll_sec
+        )
+    else:
+        backfill_scheduler = None
+
+
+def backfill_segment(start_sec, end_sec, pcm):
+    # runs in the pool, returns the transcript with the position of the segment in the source
+    audio_sec = len(pcm) / (sample_rate * 2.0)
+    if backfill_encoding != 'linear16':
+        pcm = encode_chunk(pcm, backfill_encoding, sample_rate)
+
+    for attempt in range(backfill_retries):
+        try:
+            ticket = None
+            if backfill_scheduler is not None:
+                ticket, waited = backfill_scheduler.acquire(audio_sec, scheduler_hold_sec)
+            try:
+                return start_sec, end_sec, backfill_recognizer.recognize([pcm])
+            finally:
+                if ticket is not None:
+                    backfill_scheduler.release(ticket)
+
+        except Exception as e:
+            logger.warn('Recognition of segment at {:.1f} sec failed: {}'.format(start_sec, e))
+            if attempt + 1 == backfill_retries:
+                raise
+            time.sleep(sleep_sec)
+
+
+def backfill_loop(name, src, start):
+    # transcribes a recorded source faster than realtime: the source is cut to segments at quiet points,
+    # segments are recognized by a pool of processes and committed in order to the backfill stream
+    # of the channel with timestamps relative to the beginning of the source (plus start).
+    # A job queued again after a crash skips segments committed by the previous attempt
+    def segments(process, segmenter, gate):
+        offset = 0
+        while True:
+            data = process.stdout.read(stream_frame_bytes * 10)
+            for chunk in segmenter.push(data) if data else [segmenter.flush()]:
+                if chunk is None:
+                    continue
+
+                start_sec = offset / (sample_rate * 2.0)
+                offset += len(chunk)
+                end_sec = offset / (sample_rate * 2.0)
+                if end_sec <= resume_sec:
+                    continue
+
+                speech = gate.filter(chunk)[0] if gate is not None else chunk.tobytes()
+                if speech is not None:
+                    yield start_sec, end_sec, speech
+
+            if not data:
+                return
+
+    def commit(result):
+        start_sec, end_sec, transcript = result
+        if len(transcript):
+            store.append_backfill(r, name, start + start_sec, transcript, backfill_set_len, archive_writer)
+
+        with r.pipeline() as pipe:
+            pipe.hset(key, 'done_sec', end_sec)
+            pipe.hincrby(key, 'segments', 1)
+            pipe.execute()
+
+    key = store.backfill_key(name)
+    process, pool, archive_writer = None, None, None
+
+    try:
+        resume_sec = float(r.hget(key, 'done_sec') or 0)
+        r.hincrby(key, 'attempts', 1)
+        r.hmset(key, {
+            'state': 'running',
+            'node': node_id,
+            'started': int(time.time()),
+            'duration_sec': probe_duration(src) or 0,
+            'done_sec': resume_sec
+        })
+
+        channel = r.hgetall(name)
+        creds = save_creds(name + '-backfill', channel['creds'])
+
+        segmenter = Segmenter(
+            sample_rate, chunk_sec,
+            float(channel.get('min_segment_sec') or min_segment_sec),
+            float(channel.get('max_segment_sec') or max_segment_sec),
+            segment_lookahead_sec, vad_frame_ms
+        )
+
+        threshold = channel.get('vad_threshold') or vad_threshold
+        gate = SpeechGate(sample_rate, float(threshold), vad_frame_ms, vad_hangover_ms) if threshold is not None else None
+
+        archive_writer = ArchiveWriter(archive_dir, backfill_name(name), archive_segment_bytes) if archive else None
+
+        logger.info('Backfill of channel {} from {} with {} workers since {:.1f} sec'.format(
+            name, src, backfill_workers, resume_sec)
+        )
+        process = ffmpeg_process(src, realtime = False)
+        pool = Pool(backfill_workers, backfill_init, (creds, channel['lang'], channel.get('encoding') or encoding))
+        pending = deque()
+
+        for segment in segments(process, segmenter, gate):
+            pending.append(pool.apply_async(backfill_segment, segment))
+            # a few segments per worker are in flight, so a long source is never kept in memory
+            while len(pending) >= backfill_workers * 2:
+                commit(pending.popleft().get())
+
+        while pending:
+            commit(pending.popleft().get())
+
+        logger.info('Backfill of channel {} is done'.format(name))
+        r.hmset(key, {
+            'state': 'done',
+            'finished': int(time.time())
+        })
+
+    except Exception as e:
+        logger.error('Backfill of channel {} failed: {}'.format(name, e), exc_info=True)
+        r.hmset(key, {
+            'state': 'failed',
+            'error': str(e),
+            'finished': int(time.time())
+        })
+        if pool is not None:
+            pool.terminate()
+
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        if process is not None:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        if archive_writer is not None:
+            archive_writer.close()
 
 
 def create_dir_first():
@@ -225,87 +970,312 @@ def register_channels_first():
         logger.info('Storing data for channel {}'.format(name))
         with r.pipeline() as pipe:
             pipe.multi()
+            pipe.sadd(store.channels_key, name)
             pipe.hset(name, 'src', channel['src'])
             pipe.hset(name, 'lang', channel['lang'])
             pipe.hset(name, 'creds', channel['creds'])
             pipe.hset(name, 'state', channel['state'])
+            for field in store.channel_options:
+                if channel.get(field) is not None:
+                    pipe.hset(name, field, channel[field])
             pipe.execute()
 
 
+def migrate_transcripts_first():
+    # channels of other nodes are migrated when those nodes start, old entries stay readable meanwhile
+    names = store.channel_names(r)
+    names = [name for name, owner in zip(names, store.channel_owners(r, names)) if owner in [node_id, None]]
+    for name in names:
+        migrated = store.migrate_transcript(r, name, transcript_set_len)
+        if migrated:
+            logger.info('Migrated {} transcript items of channel {}'.format(migrated, name))
+
+        migrated = store.migrate_entries(r, name)
+        if migrated:
+            logger.info('Migrated {} transcript items of channel {} to format version {}'.format(
+                migrated, name, store.entry_version))
+
+
 def reset_pids_first():
-    for name in r.keys('*'):
-        logger.info('Resetting pids for channel {}'.format(name))
-        with r.pipeline() as pipe:
-            pipe.multi()
+    # pids mean something only on the node running the channel, channels of other nodes are left alone
+    names = store.channel_names(r)
+    names = [name for name, owner in zip(names, store.channel_owners(r, names)) if owner in [node_id, None]]
+    logger.info('Resetting pids for channels {}'.format(names))
+    with r.pipeline() as pipe:
+        pipe.multi()
+        for name in names:
             pipe.hset(name, 'pid', 0)
             pipe.hset(name, 'pid_ffmpeg', 0)
-            pipe.execute()
+        pipe.execute()
+
+
+def requeue_backfills_first():
+    # processes of the previous run of the node are gone, so its jobs are queued again
+    requeued = store.requeue_backfills(r, node_id)
+    if requeued:
+        logger.info('Queued again backfills of channels {}'.format(requeued))
 
 
 def reset_transcripts_first():
-    for name in r.keys('*'):
+    for name in store.channel_names(r):
         logger.info('Resetting transcript for channel {}'.format(name))
-        r.hdel (name, 'transcript')
+        store.delete_transcript(r, name)
 
 
-def run_channels():
+def save_creds(name, creds):
+    creds_filename = os.path.join(work_dir, name + '-creds.json')
 
-    def control_channel(name, src, lang, creds, state):
+    logger.debug('Saving credentials for channel {} to file {}'.format(name, creds_filename))
+    f = open(creds_filename, 'w' )
+    f.write(base64.b64decode(creds))
+    f.close()
 
-        global processes
+    return creds_filename
 
-        if state == 'start':
-            if name not in processes.keys() or not processes[name].is_alive():
-                logger.debug('Registering process for channel {}'.format(name))
-                creds_filename = os.path.join(work_dir, name + '-creds.json')
 
-                logger.debug('Saving credentials for channel {} to file {}'.format(name, creds_filename))
-                f = open(creds_filename, 'w' )
-                f.write(base64.b64decode(creds))
-                f.close()
+def send_heartbeat():
+    store.heartbeat(r, node_id, node_capacity, len(processes), lease_ms)
 
-                logger.info('Starting process for channel {}'.format(name))
-                processes[name] = Process(
-                    target = channel_loop,
-                    name = 'channel_loop_{}'.format(name),
-                    args = (name, src, lang, creds_filename)
-                )
 
-                processes[name].start()
-                update_pid(name, processes[name].pid)
+def claim_channel(name, nodes = None):
+    # a channel is taken by the least loaded node with spare capacity, others leave it
+    if len(processes) >= node_capacity:
+        return False
+
+    if nodes is None:
+        nodes, dead = store.get_nodes(r)
+
+    load = len(processes) / float(node_capacity)
+    for node, info in nodes.items():
+        if node != node_id and info['channels'] / float(info['capacity']) < load:
+            logger.debug('Leaving channel {} to less loaded node {}'.format(name, node))
+            return False
+
+    if not store.claim_lease(r, name, node_id, lease_ms):
+        return False
+
+    logger.info('Node {} claimed channel {}'.format(node_id, name))
+    return True
+
+
+def control_channel(name, src, lang, creds, state, nodes = None):
+
+    global processes
+
+    if state == 'start':
+        if name not in processes.keys() and not claim_channel(name, nodes):
+            return
+
+        if name not in processes.keys() or not processes[name].is_alive():
+            # livesum gauges keep the last values of a dead process until it's marked dead
+            if isinstance(processes.get(name), Process):
+                metrics.process_dead(processes[name].pid)
+
+            logger.debug('Registering process for channel {}'.format(name))
+            creds_filename = save_creds(name, creds)
+
+            logger.info('Starting process for channel {}'.format(name))
+            processes[name] = channel_process(name, src, lang, creds_filename)
+
+            processes[name].start()
+            update_pid(name, processes[name].pid)
 
-        if state == 'stop':
-            if name in processes.keys():
-                if processes[name].is_alive():
-                    logger.info('Stopping process for channel {}'.format(name))
-                    processes[name].terminate()
+    # state is None when channel has been removed
+    if state in ['stop', None]:
+        if name in processes.keys():
+            if processes[name].is_alive():
+                logger.info('Stopping process for channel {}'.format(name))
+                processes[name].terminate()
 
+            if state is not None:
                 update_pid(name)
                 update_pid_ffmpeg(name)
 
-                logger.debug('Unregistering process for channel {}'.format(name))
-                del processes[name]
+            logger.debug('Unregistering process for channel {}'.format(name))
+            if isinstance(processes[name], Process):
+                metrics.process_dead(processes[name].pid)
+            del processes[name]
+            store.release_lease(r, name, node_id)
+
+
+def run_channel(name, restart = False):
+    logger.debug('Control event for channel {}'.format(name))
+
+    channel = r.hgetall(name)
+
+    if restart and name in processes.keys():
+        logger.info('Restarting process for channel {} to apply new data'.format(name))
+        control_channel(name, None, None, None, None)
+
+    control_channel(name, channel.get('src'), channel.get('lang'), channel.get('creds'), channel.get('state'))
+
+
+def run_channels():
 
     global processes
 
-    for name in r.keys('*'):
+    names = store.channel_names(r)
+    nodes, dead = store.get_nodes(r)
+    for name, channel in zip(names, store.get_channels(r, names)):
         logger.debug('Control iteration for channel {}'.format(name))
 
-        src = r.hget(name, 'src')
-        lang = r.hget(name, 'lang')
-        creds = r.hget(name, 'creds')
-        state = r.hget(name, 'state')
+        src = channel.get('src')
+        lang = channel.get('lang')
+        creds = channel.get('creds')
+        state = channel.get('state')
 
-        control_channel(name, src, lang, creds, state)
+        control_channel(name, src, lang, creds, state, nodes)
+
+    for name in set(processes.keys()) - set(names):
+        logger.info('Channel {} is not registered anymore'.format(name))
+        control_channel(name, None, None, None, None)
+
+
+def run_dead_channels():
+    for name, process in list(processes.items()):
+        if not process.is_alive():
+            logger.warn('Process of channel {} is not alive'.format(name))
+            run_channel(name)
+
+
+def end_backfill(job, exitcode):
+    # a job stays in the processing list of the node until its process exits,
+    # a job of a crashed process is queued again until it runs out of attempts
+    name = json.loads(job)['name']
+    key = store.backfill_key(name)
+    store.release_backfill(r, name, node_id)
+
+    state, attempts = r.hmget(key, 'state', 'attempts')
+    if state == 'running':
+        if int(attempts or 0) < backfill_retries:
+            logger.warn('Backfill process of channel {} exited with code {}, queueing it again'.format(
+                name, exitcode)
+            )
+            store.requeue_backfill(r, node_id, job)
+            return
+
+        logger.error('Backfill process of channel {} exited with code {}'.format(name, exitcode))
+        r.hmset(key, {
+            'state': 'failed',
+            'error': 'backfill process exited with code {}'.format(exitcode),
+            'finished': int(time.time())
+        })
+
+    store.finish_backfill(r, node_id, job)
+
+
+def run_backfills():
+    # jobs are taken from the shared queue by any node with a free backfill slot
+    global backfills
+
+    alive = []
+    for process, job in backfills:
+        if process.is_alive():
+            alive.append((process, job))
+        else:
+            metrics.process_dead(process.pid)
+            end_backfill(job, process.exitcode)
+    backfills = alive
+
+    while len(backfills) < backfill_jobs:
+        job = store.take_backfill(r, node_id, lease_ms)
+        if job is None:
+            break
+
+        data = json.loads(job)
+        logger.info('Starting backfill of channel {} from {}'.format(data['name'], data['src']))
+        process = Process(
+            target = backfill_loop,
+            name = 'backfill_loop_{}'.format(data['name']),
+            args = (data['name'], data['src'], data.get('start', 0))
+        )
+        process.start()
+        backfills.append((process, job))
+
+
+def run_heartbeat():
+    names = list(processes.keys())
+    for name, renewed in zip(names, store.renew_leases(r, names, node_id, lease_ms)):
+        if not renewed:
+            # another node may run the channel already, so its pids are not touched
+            logger.warn('Node {} lost lease of channel {}'.format(node_id, name))
+            control_channel(name, None, None, None, None)
+
+    store.renew_backfills(r, [json.loads(job)['name'] for process, job in backfills], node_id, lease_ms)
+    send_heartbeat()
+
+    nodes, dead = store.get_nodes(r)
+    if dead:
+        logger.warn('Nodes {} are dead, taking over their channels'.format(dead))
+        for node in dead:
+            requeued = store.requeue_backfills(r, node)
+            if requeued:
+                logger.warn('Queued again backfills of channels {} of dead node {}'.format(requeued, node))
+        run_channels()
+        run_backfills()
+
+
+def handle_event(message):
+    try:
+        event = json.loads(message['data'])
+        name = event['name']
+        action = event['action']
+    except Exception as e:
+        logger.error('Could not parse event {}: {}'.format(message, e))
+        return
+
+    logger.debug('Got event {} of channel {}'.format(action, name))
+
+    # pid events of the bot itself only refresh caches of the API
+    if action == 'pid':
+        return
+
+    if action == 'backfill':
+        run_backfills()
+        return
+
+    run_channel(name, restart = action == 'register')
 
 
 if __name__ == '__main__':
     create_dir_first()
     register_channels_first()
+    migrate_transcripts_first()
     reset_pids_first()
+    requeue_backfills_first()
 
     processes = {}
+    backfills = []
+
+    assert engine in ['process', 'thread'], 'Engine must be one of [process, thread] but found {}'.format(engine)
+    workers = [Worker(index) for index in range(engine_workers)]
+
+    metrics.serve(metrics_port)
+
+    events = r.pubsub(ignore_subscribe_messages = True)
+    events.subscribe(store.events_channel)
+
+    send_heartbeat()
+    run_channels()
+    reconciled = time.time()
+    heartbeat = time.time()
+    checked = time.time()
 
     while True:
-        run_channels()
-        time.sleep(sleep_sec)
+        message = events.get_message(timeout = sleep_sec)
+        if message is not None:
+            handle_event(message)
+
+        # events of many channels may never leave the loop idle, so checks have their own timer
+        if message is None or time.time() - checked >= sleep_sec:
+            run_dead_channels()
+            run_backfills()
+            checked = time.time()
+
+        if time.time() - heartbeat >= heartbeat_sec:
+            run_heartbeat()
+            heartbeat = time.time()
+
+        if time.time() - reconciled >= reconcile_sec:
+            run_channels()
+            reconciled = time.time()
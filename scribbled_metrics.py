@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+
+import config
+
+metrics_dir = getattr(config, 'metrics_dir')
+
+
+def process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError:
+        return False
+    return True
+
+
+# multiprocess mode of prometheus_client keeps values of every process in files of one directory,
+# the directory is chosen by the first process importing the module (bot supervisor or uwsgi master)
+# and inherited by forked processes, so their values are aggregated
+if 'prometheus_multiproc_dir' not in os.environ:
+    if not os.path.exists(metrics_dir):
+        os.makedirs(metrics_dir)
+
+    for entry in os.listdir(metrics_dir):
+        if entry.isdigit() and not process_alive(int(entry)):
+            shutil.rmtree(os.path.join(metrics_dir, entry), ignore_errors = True)
+
+    path = os.path.join(metrics_dir, str(os.getpid()))
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    os.environ['prometheus_multiproc_dir'] = path
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = path
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest, multiprocess, start_http_server
+
+content_type = CONTENT_TYPE_LATEST
+
+latency_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# bot
+audio_bytes = Counter(
+    'scribbled_audio_bytes_total',
+    'Bytes of audio read from ffmpeg',
+    ['channel']
+)
+upload_bytes = Counter(
+    'scribbled_upload_bytes_total',
+    'Bytes of audio sent to the recognizer',
+    ['channel']
+)
+chunk_wait = Histogram(
+    'scribbled_chunk_wait_seconds',
+    'Time waiting for audio from ffmpeg',
+    ['channel'],
+    buckets = latency_buckets
+)
+recognize_latency = Histogram(
+    'scribbled_recognize_seconds',
+    'Latency of recognition requests',
+    ['channel'],
+    buckets = latency_buckets
+)
+commit_lag = Histogram(
+    'scribbled_commit_lag_seconds',
+    'Time from reading the audio to storing its transcript',
+    ['channel'],
+    buckets = latency_buckets
+)
+ring_depth = Gauge(
+    'scribbled_ring_depth',
+    'Slots of audio waiting in the ring',
+    ['channel'],
+    multiprocess_mode = 'livesum'
+)
+ring_dropped = Counter(
+    'scribbled_ring_dropped_total',
+    'Slots of audio dropped from the full ring',
+    ['channel']
+)
+ffmpeg_restarts = Counter(
+    'scribbled_ffmpeg_restarts_total',
+    'Restarts of ffmpeg processes',
+    ['src']
+)
+scheduler_wait = Histogram(
+    'scribbled_scheduler_wait_seconds',
+    'Time of recognition requests waiting in the scheduler queue',
+    ['channel'],
+    buckets = latency_buckets
+)
+scheduler_rejected = Counter(
+    'scribbled_scheduler_rejected_total',
+    'Recognition requests rejected after waiting too long in the scheduler queue',
+    ['channel']
+)
+redis_latency = Histogram(
+    'scribbled_redis_seconds',
+    'Latency of redis calls',
+    ['operation'],
+    buckets = latency_buckets
+)
+
+# api
+request_latency = Histogram(
+    'scribbled_api_request_seconds',
+    'Latency of API requests',
+    ['route', 'method', 'status'],
+    buckets = latency_buckets
+)
+channel_cache = Counter(
+    'scribbled_api_channel_cache_total',
+    'Lookups of channel data in the cache of API workers',
+    ['result']
+)
+
+
+def registry():
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def render():
+    return generate_latest(registry())
+
+
+def serve(port):
+    start_http_server(port, registry = registry())
+
+
+def process_dead(pid):
+    multiprocess.mark_process_dead(pid)
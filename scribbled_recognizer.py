@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+
+import json
+import time
+import hashlib
+import logging
+import threading
+from datetime import datetime, timedelta
+
+try:
+    from urllib2 import Request, urlopen
+    from urllib import urlencode
+except ImportError:
+    from urllib.request import Request, urlopen
+    from urllib.parse import urlencode
+
+try:
+    import grpc
+    from google.cloud import speech
+    from google.cloud.speech import enums
+    from google.cloud.speech import types
+    from google.oauth2 import service_account
+    from google.auth.transport.requests import Request as AuthRequest
+except ImportError:
+    speech = None
+
+logger = logging.getLogger(__name__)
+
+
+def fingerprint(creds):
+    # channels registered with the same credentials share their limits
+    with open(creds, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ClientPool(object):
+    # speech clients of the process by fingerprint of credentials, shared by channels on the same credentials
+    # and kept over restarts of channels. Tokens are refreshed ahead of expiry and channels are connected
+    # in background, so the first request of a channel doesn't wait for them
+
+    scopes = ['https://www.googleapis.com/auth/cloud-platform']
+
+    def __init__(self, refresh_sec = 300, check_sec = 60, connect_sec = 10):
+        self.refresh_sec = refresh_sec
+        self.check_sec = check_sec
+        self.connect_sec = connect_sec
+        self.lock = threading.Lock()
+        self.clients = {}
+        self.thread = None
+
+    def get(self, creds):
+        key = fingerprint(creds)
+        with self.lock:
+            if key not in self.clients:
+                with open(creds) as f:
+                    credentials = service_account.Credentials.from_service_account_info(
+                        json.load(f), scopes = self.scopes)
+                client = speech.SpeechClient(credentials = credentials)
+                self.clients[key] = (client, credentials)
+
+                thread = threading.Thread(target = self.warm, name = 'client_warm', args = (client, credentials))
+                thread.daemon = True
+                thread.start()
+
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target = self.run, name = 'client_pool')
+                self.thread.daemon = True
+                self.thread.start()
+
+            return self.clients[key][0]
+
+    def warm(self, client, credentials):
+        try:
+            if credentials.expiry is None or credentials.expiry - datetime.utcnow() < timedelta(seconds = self.refresh_sec):
+                credentials.refresh(AuthRequest())
+            # connects the channel if it's idle, so it's ready for the next request
+            grpc.channel_ready_future(client.transport.channel).result(timeout = self.connect_sec)
+        except Exception as e:
+            logger.warn('Could not warm up speech client: {}'.format(e))
+
+    def run(self):
+        while True:
+            time.sleep(self.check_sec)
+            with self.lock:
+                clients = list(self.clients.values())
+            for client, credentials in clients:
+                self.warm(client, credentials)
+
+
+clients = ClientPool()
+
+
+class GoogleRecognizer(object):
+
+    encodings = {
+        'linear16': 'LINEAR16',
+        'flac': 'FLAC',
+        'ogg_opus': 'OGG_OPUS'
+    }
+
+    def __init__(self, creds, lang, sample_rate, interim_results = False, encoding = 'linear16'):
+        assert speech is not None, 'Package google-cloud-speech is not installed'
+
+        self.client = clients.get(creds)
+        self.config = types.RecognitionConfig(
+            encoding = getattr(enums.RecognitionConfig.AudioEncoding, self.encodings[encoding]),
+            sample_rate_hertz = int(sample_rate),
+            language_code = lang,
+            max_alternatives = 1
+        )
+        self.streaming_config = types.StreamingRecognitionConfig(
+            config = self.config,
+            interim_results = interim_results
+        )
+
+    def recognize(self, chunks):
+        requests = (types.StreamingRecognizeRequest(audio_content = chunk)
+            for chunk in chunks)
+
+        transcript = []
+        for response in self.client.streaming_recognize(self.streaming_config, requests):
+            for result in response.results:
+                if result.is_final:
+                    transcript.append(result.alternatives[0].transcript)
+
+        return transcript
+
+    def stream(self, audio):
+        # yields (is_final, text) for audio chunks of the generator
+        requests = (types.StreamingRecognizeRequest(audio_content = chunk)
+            for chunk in audio)
+
+        for response in self.client.streaming_recognize(self.streaming_config, requests):
+            for result in response.results:
+                yield result.is_final, result.alternatives[0].transcript
+
+
+class HttpRecognizer(object):
+    # talks to a local stand-in server, see bench/fake_recognizer.py
+
+    def __init__(self, url, lang, sample_rate, utterance_sec, encoding = 'linear16'):
+        self.url = url
+        self.lang = lang
+        self.sample_rate = sample_rate
+        self.encoding = encoding
+        self.utterance_bytes = int(sample_rate * 2 * utterance_sec)
+
+    def recognize(self, chunks):
+        query = urlencode({'lang': self.lang, 'rate': self.sample_rate, 'encoding': self.encoding})
+        request = Request(
+            '{}/recognize?{}'.format(self.url, query),
+            data = b''.join(chunks),
+            headers = {'Content-Type': 'application/octet-stream'}
+        )
+        return json.loads(urlopen(request).read().decode('utf-8'))['transcript']
+
+    def stream(self, audio):
+        utterance = []
+        size = 0
+        for chunk in audio:
+            utterance.append(chunk)
+            size += len(chunk)
+            if size >= self.utterance_bytes:
+                for text in self.recognize(utterance):
+                    yield True, text
+                utterance = []
+                size = 0
+
+        if utterance:
+            for text in self.recognize(utterance):
+                yield True, text
+
+
+def create(backend, creds, lang, sample_rate, interim_results = False, encoding = 'linear16',
+        url = None, utterance_sec = 5):
+    assert backend in ['google', 'http'], 'Recognizer backend must be one of [google, http] but found {}'.format(backend)
+
+    if backend == 'http':
+        return HttpRecognizer(url, lang, sample_rate, utterance_sec, encoding)
+    return GoogleRecognizer(creds, lang, sample_rate, interim_results, encoding)
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+import time
+import uuid
+
+# requests of all channels on all nodes wait in queues ordered by priority and arrival. Requests of the same
+# credentials wait in the queue of their bucket, only the first of them may take tokens of the bucket,
+# so a higher priority request is never overtaken while the bucket refills. The first one with enough tokens
+# waits in the global queue until it's among the first free slots of the global concurrency cap
+queue_key = 'scribbled|sched|queue'
+seen_key = 'scribbled|sched|seen'
+inflight_key = 'scribbled|sched|inflight'
+
+
+def bucket_key(fingerprint):
+    return 'scribbled|bucket|' + fingerprint
+
+
+def bucket_queue_key(fingerprint):
+    return bucket_key(fingerprint) + '|queue'
+
+
+# returns 0 when granted, -1 while waiting for a slot or for requests ahead in the bucket queue,
+# or milliseconds to refill the bucket
+acquire_script = """
+local ticket = ARGV[1]
+local score = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local concurrency = tonumber(ARGV[4])
+local request_rate = tonumber(ARGV[5])
+local audio_rate = tonumber(ARGV[6])
+local burst = tonumber(ARGV[7])
+local audio_sec = tonumber(ARGV[8])
+local hold_ms = tonumber(ARGV[9])
+local stale_ms = tonumber(ARGV[10])
+
+redis.call('zremrangebyscore', KEYS[3], '-inf', now)
+
+local stale = redis.call('zrangebyscore', KEYS[2], '-inf', now - stale_ms)
+for i = 1, #stale do
+    redis.call('zrem', KEYS[1], stale[i])
+    redis.call('zrem', KEYS[2], stale[i])
+end
+redis.call('zadd', KEYS[2], now, ticket)
+
+-- requests of dead processes leave the head of the bucket queue
+redis.call('zadd', KEYS[5], 'NX', score, ticket)
+while true do
+    local head = redis.call('zrange', KEYS[5], 0, 0)[1]
+    if head == ticket or redis.call('zscore', KEYS[2], head) then
+        break
+    end
+    redis.call('zrem', KEYS[5], head)
+end
+
+if redis.call('zrank', KEYS[5], ticket) > 0 then
+    -- only the first request of the bucket competes for slots, so others don't hold back other credentials
+    redis.call('zrem', KEYS[1], ticket)
+    return -1
+end
+
+local bucket = redis.call('hmget', KEYS[4], 'requests', 'audio', 'ts')
+local request_cap = request_rate * burst
+local audio_cap = audio_rate * burst
+local elapsed = math.max(0, now - (tonumber(bucket[3]) or now)) / 1000
+local requests = math.min(request_cap, (tonumber(bucket[1]) or request_cap) + elapsed * request_rate)
+local audio = math.min(audio_cap, (tonumber(bucket[2]) or audio_cap) + elapsed * audio_rate)
+local audio_need = math.min(audio_sec, audio_cap)
+
+if requests < 1 or audio < audio_need then
+    redis.call('zrem', KEYS[1], ticket)
+    return math.ceil(math.max((1 - requests) / request_rate, (audio_need - audio) / audio_rate) * 1000)
+end
+
+redis.call('zadd', KEYS[1], 'NX', score, ticket)
+
+if redis.call('zrank', KEYS[1], ticket) >= concurrency - redis.call('zcard', KEYS[3]) then
+    return -1
+end
+
+redis.call('hmset', KEYS[4], 'requests', requests - 1, 'audio', audio - audio_need, 'ts', now)
+redis.call('pexpire', KEYS[4], math.ceil(burst * 1000) + 60000)
+redis.call('zrem', KEYS[1], ticket)
+redis.call('zrem', KEYS[2], ticket)
+redis.call('zrem', KEYS[5], ticket)
+redis.call('zadd', KEYS[3], now + hold_ms, ticket)
+return 0
+"""
+
+
+# charges audio seconds sent after the grant, the bucket may go below zero and later requests wait for it to refill
+charge_script = """
+local now = tonumber(ARGV[1])
+local request_rate = tonumber(ARGV[2])
+local audio_rate = tonumber(ARGV[3])
+local burst = tonumber(ARGV[4])
+local audio_sec = tonumber(ARGV[5])
+
+local bucket = redis.call('hmget', KEYS[1], 'requests', 'audio', 'ts')
+local request_cap = request_rate * burst
+local audio_cap = audio_rate * burst
+local elapsed = math.max(0, now - (tonumber(bucket[3]) or now)) / 1000
+local requests = math.min(request_cap, (tonumber(bucket[1]) or request_cap) + elapsed * request_rate)
+local audio = math.min(audio_cap, (tonumber(bucket[2]) or audio_cap) + elapsed * audio_rate)
+
+redis.call('hmset', KEYS[1], 'requests', requests, 'audio', audio - audio_sec, 'ts', now)
+redis.call('pexpire', KEYS[1], math.ceil(burst * 1000) + 60000)
+return 0
+"""
+
+
+class Rejected(Exception):
+    pass
+
+
+class Scheduler(object):
+
+    def __init__(self, r, fingerprint, priority, concurrency, request_rate, audio_rate, burst_sec,
+            max_wait_sec, poll_sec):
+        self.r = r
+        self.acquire_script = r.register_script(acquire_script)
+        self.charge_script = r.register_script(charge_script)
+        self.bucket = bucket_key(fingerprint)
+        self.bucket_queue = bucket_queue_key(fingerprint)
+        self.priority = priority
+        self.concurrency = concurrency
+        self.request_rate = request_rate
+        self.audio_rate = audio_rate
+        self.burst_sec = burst_sec
+        self.max_wait_sec = max_wait_sec
+        self.poll_sec = poll_sec
+        # a request not polling for stale_sec is taken for a dead one and leaves the queues
+        self.stale_sec = max(1, poll_sec * 20)
+
+    def acquire(self, audio_sec, hold_sec, stop = None):
+        # returns ticket of the granted request and seconds of waiting,
+        # raises Rejected after max_wait_sec or as soon as the stop event is set
+        ticket = uuid.uuid4().hex
+        started = time.time()
+        # higher priority goes first, requests of the same priority are served in order of arrival
+        score = -self.priority * 1e13 + int(started * 1000)
+
+        while True:
+            now = time.time()
+            wait_ms = self.acquire_script(
+                keys = [queue_key, seen_key, inflight_key, self.bucket, self.bucket_queue],
+                args = [ticket, score, int(now * 1000), self.concurrency, self.request_rate, self.audio_rate,
+                    self.burst_sec, audio_sec, int(hold_sec * 1000), int(self.stale_sec * 1000)]
+            )
+            if wait_ms == 0:
+                return ticket, now - started
+
+            stopped = stop is not None and stop.is_set()
+            if stopped or now - started >= self.max_wait_sec:
+                self.r.zrem(queue_key, ticket)
+                self.r.zrem(seen_key, ticket)
+                self.r.zrem(self.bucket_queue, ticket)
+                if stopped:
+                    raise Rejected('Request was stopped while waiting in the queue')
+                raise Rejected('Request waited {:.1f} sec in the queue'.format(now - started))
+
+            # a request waiting for the bucket to refill keeps its place, so it polls before it gets stale
+            delay = self.poll_sec if wait_ms < 0 else min(wait_ms / 1000.0, self.max_wait_sec, self.stale_sec / 2.0)
+            if stop is not None:
+                stop.wait(delay)
+            else:
+                time.sleep(delay)
+
+    def release(self, ticket, audio_sec = 0):
+        # audio_sec is charged for requests which don't know their audio when they're granted
+        self.r.zrem(inflight_key, ticket)
+        if audio_sec:
+            self.charge_script(
+                keys = [self.bucket],
+                args = [int(time.time() * 1000), self.request_rate, self.audio_rate, self.burst_sec, audio_sec]
+            )
@@ -0,0 +1,606 @@
+#!/usr/bin/env python
+
+import re
+import zlib
+import json
+import redis
+import msgpack
+
+# the fastest available encoder serializes responses, they are the same json
+try:
+    import ujson as fast_json
+except ImportError:
+    try:
+        import simplejson as fast_json
+    except ImportError:
+        fast_json = json
+
+# optional per channel settings stored next to src and lang
+channel_options = [
+    'vad_threshold',
+    'encoding',
+    'priority',
+    'min_segment_sec',
+    'max_segment_sec'
+]
+
+
+channels_key = 'scribbled|channels'
+# set once the channels of an older keyspace are indexed
+channels_indexed_key = 'scribbled|channels|indexed'
+
+
+events_channel = 'scribbled|events'
+
+
+def publish_event(r, name, action):
+    # r may be a pipeline to publish the event within a transaction
+    return r.publish(events_channel, json.dumps({
+        'name': name,
+        'action': action
+    }))
+
+
+def index_channels(r):
+    # keys with pipe symbol belong to channels, but are not channels
+    names = [name for name in r.scan_iter(count = 1000) if '|' not in name]
+    if names:
+        r.sadd(channels_key, *names)
+    r.set(channels_indexed_key, 1)
+    return names
+
+
+def channel_names(r):
+    names = r.smembers(channels_key)
+    # channels of an older keyspace are indexed once, even if new channels are in the set already
+    if not r.exists(channels_indexed_key):
+        names = set(names) | set(index_channels(r))
+    return sorted(names)
+
+
+def get_channels(r, names):
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            pipe.hgetall(name)
+        return pipe.execute()
+
+
+def channels_exist(r, names):
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            pipe.exists(name)
+        return [bool(exists) for exists in pipe.execute()]
+
+
+# every channel runs on one bot node holding its lease, nodes announce themselves with expiring heartbeats
+nodes_key = 'scribbled|nodes'
+
+
+def node_key(node):
+    return 'scribbled|node|' + node
+
+
+def lease_key(name):
+    return name + '|lease'
+
+
+renew_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+release_script = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def claim_lease(r, name, node, lease_ms):
+    if r.set(lease_key(name), node, nx = True, px = lease_ms):
+        return True
+    return bool(r.register_script(renew_script)(keys = [lease_key(name)], args = [node, lease_ms]))
+
+
+def renew_leases(r, names, node, lease_ms):
+    # returns list of flags, false when the lease has expired or belongs to another node
+    renew = r.register_script(renew_script)
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            renew(keys = [lease_key(name)], args = [node, lease_ms], client = pipe)
+        return [bool(renewed) for renewed in pipe.execute()]
+
+
+def release_lease(r, name, node):
+    return r.register_script(release_script)(keys = [lease_key(name)], args = [node])
+
+
+def channel_owners(r, names):
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            pipe.get(lease_key(name))
+        return pipe.execute()
+
+
+def heartbeat(r, node, capacity, channels, ttl_ms):
+    with r.pipeline(transaction = False) as pipe:
+        pipe.sadd(nodes_key, node)
+        pipe.set(node_key(node), json.dumps({
+            'capacity': capacity,
+            'channels': channels
+        }), px = ttl_ms)
+        pipe.execute()
+
+
+def get_nodes(r):
+    # returns (alive nodes with their heartbeat data, dead nodes), dead nodes are forgotten
+    nodes = sorted(r.smembers(nodes_key))
+    with r.pipeline(transaction = False) as pipe:
+        for node in nodes:
+            pipe.get(node_key(node))
+        data = pipe.execute()
+
+    alive = dict((node, json.loads(info)) for node, info in zip(nodes, data) if info is not None)
+    dead = [node for node, info in zip(nodes, data) if info is None]
+    if dead:
+        r.srem(nodes_key, *dead)
+    return alive, dead
+
+
+# recorded sources waiting for transcription, progress of a job is kept in the hash of its channel.
+# Jobs are pushed to the head of the queue and taken from its tail to the processing list of a node,
+# where they stay until their process exits, the job lease is renewed by the node while the job runs
+backfill_queue = 'scribbled|backfill'
+
+
+def backfill_processing_key(node):
+    return 'scribbled|backfill|' + node
+
+
+def backfill_key(name):
+    return name + '|backfill'
+
+
+def backfill_lease_key(name):
+    return name + '|backfill|lease'
+
+
+take_script = """
+local job = redis.call('rpoplpush', KEYS[1], KEYS[2])
+if not job then
+    return false
+end
+local name = cjson.decode(job)['name']
+redis.call('set', name .. '|backfill|lease', ARGV[1], 'px', ARGV[2])
+redis.call('hmset', name .. '|backfill', 'state', 'running', 'node', ARGV[1])
+return job
+"""
+
+
+def take_backfill(r, node, lease_ms):
+    # returns the next job and leases it to the node at once, so a job is always queued or leased
+    return r.register_script(take_script)(keys = [backfill_queue, backfill_processing_key(node)],
+        args = [node, lease_ms])
+
+
+def renew_backfills(r, names, node, lease_ms):
+    # leases taken over by another node are left alone
+    renew = r.register_script(renew_script)
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            renew(keys = [backfill_lease_key(name)], args = [node, lease_ms], client = pipe)
+        return [bool(renewed) for renewed in pipe.execute()]
+
+
+def release_backfill(r, name, node):
+    return r.register_script(release_script)(keys = [backfill_lease_key(name)], args = [node])
+
+
+def backfill_active(r, name):
+    # a job is active while it's leased by a node or waits in the queue
+    if r.exists(backfill_lease_key(name)):
+        return True
+    if r.hget(backfill_key(name), 'state') != 'queued':
+        return False
+    return any(json.loads(job)['name'] == name for job in r.lrange(backfill_queue, 0, -1))
+
+
+def finish_backfill(r, node, job):
+    r.lrem(backfill_processing_key(node), 0, job)
+
+
+requeue_script = """
+if redis.call('lrem', KEYS[1], 0, ARGV[1]) == 0 then
+    return 0
+end
+redis.call('rpush', KEYS[2], ARGV[1])
+redis.call('hset', KEYS[3], 'state', 'queued')
+return 1
+"""
+
+
+def requeue_backfill(r, node, job):
+    # the job goes to the tail of the queue, so it's taken next. It's queued only by the one
+    # which removes it from the processing list, nodes finding the same dead node don't queue it twice
+    name = json.loads(job)['name']
+    return bool(r.register_script(requeue_script)(
+        keys = [backfill_processing_key(node), backfill_queue, backfill_key(name)], args = [job]))
+
+
+def requeue_backfills(r, node):
+    # jobs left by a dead or restarted node are queued again, finished jobs and jobs replaced by a new one
+    # are dropped, returns names of channels of queued jobs
+    names = []
+    for job in r.lrange(backfill_processing_key(node), 0, -1):
+        name = json.loads(job)['name']
+        if r.hget(backfill_key(name), 'state') == 'running':
+            if requeue_backfill(r, node, job):
+                names.append(name)
+        else:
+            finish_backfill(r, node, job)
+    return names
+
+
+def backfill_transcript_key(name):
+    return name + '|backfill|transcript'
+
+
+def json_dumps(data):
+    return fast_json.dumps(data)
+
+
+def transcript_key(name):
+    return name + '|transcript'
+
+
+def doc_key(name):
+    return name + '|doc'
+
+
+def terms_key(name):
+    return name + '|terms'
+
+
+def term_key(name, term):
+    return name + '|idx|' + term
+
+
+def tokenize(text):
+    return set(re.findall(r'\w+', text.lower(), re.UNICODE))
+
+
+def entry_terms(transcript):
+    terms = set()
+    for text in transcript:
+        terms.update(tokenize(text))
+    return [term.encode('utf-8') if not isinstance(term, str) else term for term in terms]
+
+
+# version 1 entries keep transcript as json text, version 2 entries (field v) keep it as msgpack,
+# compressed with zlib (field z) when it's longer than compress_bytes. Timestamp is a plain field of both,
+# so ranges and documents don't unpack transcripts
+entry_version = '2'
+compress_bytes = 512
+
+
+def encode_fields(timestamp, transcript):
+    data = msgpack.packb(transcript, use_bin_type = True)
+    compressed = len(data) > compress_bytes
+    return {
+        'v': entry_version,
+        'timestamp': timestamp,
+        'z': int(compressed),
+        'transcript': zlib.compress(data) if compressed else data
+    }
+
+
+def entry_fields(fields):
+    # returns (timestamp, transcript) of an entry of any version
+    if fields.get('v') is None:
+        return int(fields['timestamp']), json.loads(fields['transcript'])
+
+    data = fields['transcript']
+    if fields.get('z') == '1':
+        data = zlib.decompress(data)
+    return int(fields['timestamp']), msgpack.unpackb(data, raw = False)
+
+
+def index_entry(pipe, name, entry_id, timestamp, transcript):
+    # postings of every term are stream ids scored by timestamp
+    terms = entry_terms(transcript)
+    for term in terms:
+        pipe.zadd(term_key(name, term), {entry_id: timestamp})
+    if terms:
+        pipe.sadd(terms_key(name), *terms)
+
+
+def unindex_entry(pipe, name, entry):
+    entry_id, fields = entry
+    for term in entry_terms(entry_fields(fields)[1]):
+        pipe.zrem(term_key(name, term), entry_id)
+
+
+def index_transcript(r, name):
+    with r.pipeline(transaction = False) as pipe:
+        for entry_id, fields in r.xrange(transcript_key(name)):
+            timestamp, transcript = entry_fields(fields)
+            index_entry(pipe, name, entry_id, timestamp, transcript)
+        pipe.execute()
+
+
+def delete_index(pipe, r, name):
+    delete_indexes(pipe, r, [name])
+
+
+def delete_indexes(pipe, r, names):
+    # terms of all channels are read with one round trip, keys are deleted by the pipe
+    with r.pipeline(transaction = False) as terms_pipe:
+        for name in names:
+            terms_pipe.smembers(terms_key(name))
+        terms = terms_pipe.execute()
+
+    for name, channel_terms in zip(names, terms):
+        for term in channel_terms:
+            pipe.delete(term_key(name, term))
+        pipe.delete(terms_key(name))
+
+
+updates_channel = 'scribbled|transcripts'
+
+
+def gzip_data(data):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def update_document(r, name, cursor, timestamp):
+    # an append only moves etag of the document, its body is rebuilt when it's served after the change,
+    # r may be a pipeline
+    return r.hmset(doc_key(name), {
+        'etag': cursor,
+        'modified': timestamp
+    })
+
+
+def materialize_transcript(r, name):
+    # serializes response of full transcript, the body is tagged with cursor of its last item,
+    # returns fields of the document or None if there is no transcript
+    entries = r.xrange(transcript_key(name))
+    if not entries:
+        return None
+
+    cursor, fields = entries[-1]
+    body = json_dumps({
+        'name': name,
+        'transcript': [decode_entry(entry) for entry in entries],
+        'result': 'ok',
+        'full_set': len(entries),
+        'cursor': cursor
+    })
+    document = {
+        'body_etag': cursor,
+        'body': body,
+        'body_gz': gzip_data(body)
+    }
+    r.hmset(doc_key(name), document)
+    return document
+
+
+def append_transcript(r, name, timestamp, transcript, maxlen, archive = None):
+    key = transcript_key(name)
+
+    # items pushed out of the window by this append leave the search index together with the window
+    length = r.xlen(key)
+    evicted = r.xrange(key, count = length - maxlen + 1) if length >= maxlen else []
+
+    entry_id = r.xadd(key, encode_fields(timestamp, transcript), maxlen = maxlen, approximate = False)
+
+    # archive keeps items older than the window on disk
+    if archive is not None and evicted:
+        archive.append([entry_fields(fields) for entry_id, fields in evicted])
+
+    with r.pipeline(transaction = False) as pipe:
+        index_entry(pipe, name, entry_id, timestamp, transcript)
+        for entry in evicted:
+            unindex_entry(pipe, name, entry)
+        update_document(pipe, name, entry_id, timestamp)
+        pipe.execute()
+
+    r.publish(updates_channel, json.dumps({
+        'name': name,
+        'cursor': entry_id
+    }))
+    return entry_id
+
+
+def append_backfill(r, name, timestamp, transcript, maxlen, archive = None):
+    # backfilled items are kept apart from the live window in a stream with ids from their own timestamps,
+    # so ranges find them by the time of the source. They don't touch the document, search index
+    # or updates of the live transcript. Ids of a stream only grow, an item earlier than the last one
+    # gets the next free id
+    key = backfill_transcript_key(name)
+
+    last = r.xrevrange(key, count = 1)
+    # 0-0 is not a valid id, a source starting at 0 gets the first one after it
+    ms = max(int(timestamp * 1000), 1)
+    if last:
+        ms = max(ms, int(last[0][0].split('-')[0]) + 1)
+
+    length = r.xlen(key)
+    evicted = r.xrange(key, count = length - maxlen + 1) if length >= maxlen else []
+
+    entry_id = r.xadd(key, encode_fields(int(timestamp), transcript), id = '{}-0'.format(ms),
+        maxlen = maxlen, approximate = False)
+
+    if archive is not None and evicted:
+        archive.append([entry_fields(fields) for entry_id, fields in evicted])
+    return entry_id
+
+
+def decode_entry(entry):
+    timestamp, transcript = entry_fields(entry[1])
+    return {
+        timestamp: transcript
+    }
+
+
+def read_transcript(r, name, count = 0, since = None, until = None, backfill = False):
+    key = backfill_transcript_key(name) if backfill else transcript_key(name)
+    start = '-' if since is None else int(since) * 1000
+    end = '+' if until is None else (int(until) + 1) * 1000 - 1
+
+    if count:
+        entries = r.xrevrange(key, max = end, min = start, count = count)
+        entries.reverse()
+    else:
+        entries = r.xrange(key, min = start, max = end)
+
+    cursor = entries[-1][0] if entries else None
+    return [decode_entry(entry) for entry in entries], cursor
+
+
+def read_transcripts(r, names, count = 0):
+    # latest items of many channels with one round trip, returns (items, cursor, full_set) per channel
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            if count:
+                pipe.xrevrange(transcript_key(name), count = count)
+            else:
+                pipe.xrange(transcript_key(name))
+            pipe.xlen(transcript_key(name))
+        replies = pipe.execute()
+
+    results = []
+    for i in range(len(names)):
+        entries, length = replies[2 * i], replies[2 * i + 1]
+        if count:
+            entries = entries[::-1]
+        cursor = entries[-1][0] if entries else None
+        results.append(([decode_entry(entry) for entry in entries], cursor, length))
+    return results
+
+
+def read_after(r, name, cursor, count = None):
+    # returns list of (cursor, item) stored after the cursor
+    result = r.xread({transcript_key(name): cursor}, count = count)
+    entries = result[0][1] if result else []
+    return [(entry[0], decode_entry(entry)) for entry in entries]
+
+
+def last_cursor(r, name):
+    entries = r.xrevrange(transcript_key(name), count = 1)
+    return entries[0][0] if entries else '0-0'
+
+
+def transcript_length(r, name, backfill = False):
+    return r.xlen(backfill_transcript_key(name) if backfill else transcript_key(name))
+
+
+def delete_transcript(r, name):
+    with r.pipeline() as pipe:
+        pipe.multi()
+        pipe.hdel(name, 'transcript')
+        pipe.delete(transcript_key(name))
+        pipe.delete(doc_key(name))
+        pipe.delete(backfill_transcript_key(name))
+        delete_index(pipe, r, name)
+        result = pipe.execute()
+    return any(result[:4])
+
+
+def search_transcripts(r, names, terms, since = None, limit = 100):
+    start = '-inf' if since is None else int(since)
+
+    with r.pipeline(transaction = False) as pipe:
+        for name in names:
+            for term in terms:
+                pipe.zrangebyscore(term_key(name, term), start, '+inf')
+        postings = pipe.execute()
+
+    hits = []
+    for i, name in enumerate(names):
+        found = [set(ids) for ids in postings[i * len(terms):(i + 1) * len(terms)]]
+        for entry_id in set.intersection(*found) if found else []:
+            hits.append((tuple(int(part) for part in entry_id.split('-')), name, entry_id))
+
+    hits.sort(reverse = True)
+    hits = hits[:limit]
+
+    with r.pipeline(transaction = False) as pipe:
+        for order, name, entry_id in hits:
+            pipe.xrange(transcript_key(name), entry_id, entry_id)
+        entries = pipe.execute()
+
+    results = []
+    for (order, name, entry_id), found in zip(hits, entries):
+        if found:
+            results.append({
+                'name': name,
+                'cursor': entry_id,
+                'transcript': decode_entry(found[0])
+            })
+    return results
+
+
+def migrate_transcript(r, name, maxlen):
+    # transcripts used to be stored as json list in the channel hash
+    data = r.hget(name, 'transcript')
+    if data is None:
+        return 0
+
+    transcript_set = json.loads(data)
+
+    # ids come from timestamps of the items, so ranges and search find the history by its time,
+    # items of the same second are numbered, ids never go below the last one of the stream
+    last = r.xrevrange(transcript_key(name), count = 1)
+    previous = tuple(int(part) for part in last[0][0].split('-')) if last else (0, 0)
+
+    with r.pipeline() as pipe:
+        pipe.multi()
+        for item in transcript_set:
+            for timestamp, transcript in item.items():
+                entry_id = (int(timestamp) * 1000, 0)
+                if entry_id <= previous:
+                    entry_id = (previous[0], previous[1] + 1)
+                previous = entry_id
+
+                pipe.xadd(transcript_key(name), encode_fields(timestamp, transcript), id = '{}-{}'.format(*entry_id),
+                    maxlen = maxlen, approximate = False)
+        pipe.hdel(name, 'transcript')
+        pipe.execute()
+
+    index_transcript(r, name)
+    cursor, fields = r.xrevrange(transcript_key(name), count = 1)[0]
+    update_document(r, name, cursor, fields['timestamp'])
+    return len(transcript_set)
+
+
+def migrate_entries(r, name):
+    # rewrites entries of older versions in the current format keeping their ids, the stream is rebuilt
+    # aside and replaces the old one at once, unless an entry has been appended meanwhile, then it's retried
+    key = transcript_key(name)
+    rebuilt = key + '|migrate'
+
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch(key)
+                entries = pipe.xrange(key)
+                if all(fields.get('v') == entry_version for entry_id, fields in entries):
+                    return 0
+
+                pipe.multi()
+                pipe.delete(rebuilt)
+                for entry_id, fields in entries:
+                    timestamp, transcript = entry_fields(fields)
+                    pipe.xadd(rebuilt, encode_fields(timestamp, transcript), id = entry_id)
+                pipe.rename(rebuilt, key)
+                pipe.execute()
+                return len(entries)
+
+            except redis.WatchError:
+                continue